@@ -19,7 +19,7 @@
 # monthly rebalancing
 
 import k_data
-from collections import deque
+import esg_store
 class ESGFactorMomentumStrategy(QCAlgorithm):
     def Initialize(self):
         self.SetStartDate(2009, 6, 1)
@@ -30,84 +30,79 @@ class ESGFactorMomentumStrategy(QCAlgorithm):
         # Decile weighting.
         # True - Value weighted
         # False - Equally weighted
-        self.value_weighting = True             
+        self.value_weighting = k_data.Parameter(self, 'value_weighting', True)
         self.symbol = 'SPY'
         self.AddEquity(self.symbol, Resolution.Daily)
+        # Columnar ESG cache is used when local copy of the decile file exists.
+        ESGData.store = esg_store.ESGStore.TryLoad()
+        # ESG rows are consumed only at month start selection. None - emit every row.
+        ESGData.calendar = esg_store.SamplingCalendar(esg_store.MonthStarts(self.StartDate, self.EndDate, self.Securities[self.symbol].Exchange.Hours.IsDateOpen))
         self.esg_data = self.AddData(ESGData, 'ESG', Resolution.Daily)
-        self.tickers = []
-        self.holding_period = 3
-        self.managed_queue = deque(maxlen = self.holding_period + 1)
+        # Signals precomputed over whole store. Looked up by position of current row, None - computed from history.
+        self.signals = esg_store.ESGSignals(ESGData.store, ESGData.calendar) if ESGData.store is not None else None
+        self.signal_position = None
+        self.universe = None
+        self.holding_period = k_data.Parameter(self, 'holding_period', 3)
+        self.tranche_book = k_data.TrancheBook(self.holding_period + 1)
+        self.rebalancer = k_data.TargetRebalancer(self)
 
         # Monthly ESG decile data.
-        self.esg = {}
-        self.period = 14
+        self.esg = None
+        self.period = k_data.Parameter(self, 'period', 14)
         self.selection_flag = False
         self.rebalance_flag = False
+        # Previous selection. Fee model is shared by all securities.
+        self.universe_tracker = k_data.UniverseTracker()
+        self.fee_model = k_data.CustomFeeModel(self)
         self.UniverseSettings.Resolution = Resolution.Daily
         self.AddUniverse(self.CoarseSelectionFunction, self.FineSelectionFunction)
         self.Schedule.On(self.DateRules.MonthStart(self.symbol), self.TimeRules.AfterMarketOpen(self.symbol), self.Selection)
     
     def OnSecuritiesChanged(self, changes):
+        # AddedSecurities is already the delta against previous selection. Fee model instance is shared.
         for security in changes.AddedSecurities:
-            security.SetFeeModel(k_data.CustomFeeModel(self))
+            security.SetFeeModel(self.fee_model)
     
     def CoarseSelectionFunction(self, coarse):
         if not self.selection_flag:
             return Universe.Unchanged
     
         self.selection_flag = False        
-        selected = [x.Symbol for x in coarse if (x.Symbol.Value).lower() in self.tickers]
+        selected = [x.Symbol for x in coarse if x.Symbol.Value in self.universe]
         return selected
     
     def FineSelectionFunction(self, fine):
         fine = [x for x in fine if x.EarningReports.BasicAverageShares.ThreeMonths > 0 and x.EarningReports.BasicEPS.TwelveMonths > 0 and x.ValuationRatios.PERatio > 0]
         self.rebalance_flag = True
         
-        # Momentum/market cap pair.
-        momentum_market_cap = {}
-       
-        # Momentum calc.
-        for stock in fine:
-            symbol = stock.Symbol
-            ticker = symbol.Value
-            # ESG data for 14 months is ready.
-            if ticker in self.esg and len(self.esg[ticker]) == self.esg[ticker].maxlen:
-                esg_data = [x for x in self.esg[ticker]]               
-                esg_decile_2_months_ago = esg_data[-3]
-                esg_decile_14_months_ago = esg_data[0]
-                
-                if esg_decile_14_months_ago != 0 and esg_decile_2_months_ago != 0:
-                    # Momentum as difference.
-                    # momentum = esg_decile_2_months_ago - esg_decile_14_months_ago
-                    
-                    # Momentum as ratio.
-                    momentum = (esg_decile_2_months_ago / esg_decile_14_months_ago) - 1
-                    
-                    market_cap = stock.EarningReports.BasicAverageShares.ThreeMonths * stock.EarningReports.BasicEPS.TwelveMonths * stock.ValuationRatios.PERatio
-                    
-                    # Store momentum/market cap pair.
-                    momentum_market_cap[symbol] = [momentum, market_cap]
-                
-        if len(momentum_market_cap) == 0: return []
-        
-        # Momentum sorting.
-        sorted_by_momentum = sorted(momentum_market_cap.items(), key = lambda x: x[1][0], reverse = True)
-        decile = int(len(sorted_by_momentum) / 10)
-        long = [x for x in sorted_by_momentum[:decile]]
-        short = [x for x in sorted_by_momentum[-decile:]]
+        # ESG data for 14 months is ready.
+        if self.esg is None or not self.esg.IsReady(): return self.universe_tracker.Select([])
+        symbols = [stock.Symbol for stock in fine]
+        market_caps = [stock.EarningReports.BasicAverageShares.ThreeMonths * stock.EarningReports.BasicEPS.TwelveMonths * stock.ValuationRatios.PERatio for stock in fine]
         
-        if len(long + short) == 0: 
-            # Store empty item.
-            self.managed_queue.append(RebalanceQueueItem([], []))
-            return []
+        # Momentum as ratio of deciles 2 and 14 months ago. Top and bottom decile by momentum.
+        if self.signal_position is not None:
+            scores = self.signals.Gather(self.signals.Momentum(2, self.period - 1), self.signal_position, [x.Value for x in symbols], float('nan'))
+            long_tail, short_tail, ranked = k_data.RankScores(symbols, scores, market_caps)
+        else:
+            columns = [self.esg.Column(x.Value) for x in symbols]
+            long_tail, short_tail, ranked = k_data.RankMomentum(symbols, columns, self.esg.Lag(2), self.esg.Lag(self.period - 1), market_caps)
+        if ranked == 0: return self.universe_tracker.Select([])
         
-        self.managed_queue.append(RebalanceQueueItem(long, short))
+        # New tranche. Empty one is stored too.
+        long_weights, short_weights = k_data.TrancheWeights(long_tail.caps, short_tail.caps, self.holding_period, self.value_weighting)
+        self.tranche_book.Append(long_tail.symbols, long_weights, short_tail.symbols, short_weights)
         self.rebalance_flag = True
         
-        return [x[0] for x in long + short]
+        return self.universe_tracker.Select(long_tail.symbols + short_tail.symbols)
      
     def IsInvested(self, symbol):
         return self.Securities.ContainsKey(symbol) and self.Portfolio[symbol].Invested       
+
+    # Signal panels used by FineSelectionFunction. Called by parameter sweep before runs are fanned out.
+    def PrecomputeSignals(self):
+        if self.signals is not None:
+            self.signals.Precompute(momentum = [(2, self.period - 1, True)])
     
     def OnData(self, data):
         if not self.rebalance_flag:
@@ -115,65 +110,50 @@ class ESGFactorMomentumStrategy(QCAlgorithm):
         self.rebalance_flag = False
 
         # Trade execution.
-        if len(self.managed_queue) == 0: return
+        if len(self.tranche_book) == 0: return
 
-        # Liquidate first items if queue is full.
-        if len(self.managed_queue) == self.managed_queue.maxlen:
-            item_to_liquidate = self.managed_queue.popleft()
-            for symbol, momentum_market_cap in item_to_liquidate.long_symbols + item_to_liquidate.short_symbols:
-                self.Liquidate(symbol)
+        # Roll off oldest tranche if book is full.
+        expired = self.tranche_book.PopOldest() if self.tranche_book.IsFull() else None
         
-        curr_stock_set = self.managed_queue[-1]
-        if curr_stock_set.count == 0: return
+        newest = self.tranche_book.Newest()
+        if newest.count == 0 and (expired is None or expired.count == 0): return
         
-        # Open new trades.
-        if self.value_weighting:
-            weight = 1 / (self.holding_period * 2)
-            
-            total_market_cap_long = sum([x[1][1] for x in curr_stock_set.long_symbols])
-            for symbol, momentum_market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight * (momentum_market_cap[1] / total_market_cap_long))
-                
-            total_market_cap_short = sum([x[1][1] for x in curr_stock_set.short_symbols])
-            for symbol, momentum_market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight * (momentum_market_cap[1] / total_market_cap_short))
-        else:
-            weight = 1 / (self.holding_period * curr_stock_set.count)
-            
-            # Equally weighted.
-            for symbol, market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight)
-            for symbol, market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight)
+        # Trade to netted weights of all live tranches. Symbols held in several tranches are not liquidated and bought back.
+        self.rebalancer.Rebalance(self.tranche_book.NetExposure())
 
     def Selection(self):
         # Store universe tickers.
-        if len(self.tickers) == 0:
-            self.tickers = [x.Key for x in self.esg_data.GetLastData().GetStorageDictionary()]
+        data = self.esg_data.GetLastData()
+        row = data.Row
+        if self.universe is None:
+            self.universe = k_data.TickerIndex(row.schema.tickers)
+        
+        # Position of current row in precomputed signals.
+        self.signal_position = self.signals.Track(data.Index, self.period) if self.signals is not None else None
         
         # Store history for every ticker.
-        for ticker in self.tickers:
-            ticker_u = ticker.upper()
-            if ticker_u not in self.esg:
-                self.esg[ticker_u] = deque(maxlen = self.period)
-                
-            decile = self.esg_data.GetLastData()[ticker]
-            self.esg[ticker_u].append(decile)
+        if self.esg is None:
+            self.esg = k_data.CrossSectionHistory(self.universe, self.period)
+        self.esg.Append(row.values)
         
         self.selection_flag = True
 
-class RebalanceQueueItem():
-    def __init__(self, long_symbols, short_symbols):
-        self.long_symbols = long_symbols
-        self.short_symbols = short_symbols
-        self.count = len(long_symbols + short_symbols)
-
 # ESG data.
 class ESGData(PythonData):
+    # Optional esg_store.ESGStore. Rows are served as views into it instead of parsing text.
+    store = None
+    # Ticker schema shared by all rows.
+    schema = None
+    # Optional esg_store.SamplingCalendar. Rows off the calendar are skipped unparsed.
+    calendar = None
+    
     def __init__(self):
-        self.tickers = []
+        self.Row = None
+        self.Index = None   # store row, None if parsed from text
     
     def GetSource(self, config, date, isLiveMode):
+        if ESGData.store is not None:
+            return SubscriptionDataSource(ESGData.store.source_path, SubscriptionTransportMedium.LocalFile, FileFormat.Csv)
         return SubscriptionDataSource("data.quantpedia.com/backtesting_data/economic/esg_deciles_data.csv", SubscriptionTransportMedium.RemoteFile, FileFormat.Csv)
     
     def Reader(self, config, line, date, isLiveMode):
@@ -181,19 +161,30 @@ class ESGData(PythonData):
         data.Symbol = config.Symbol
         
         if not line[0].isdigit():
-            self.tickers = [x for x in line.split(';')][1:]
+            ESGData.schema = esg_store.Schema(line.split(';')[1:])
+            if ESGData.calendar is not None:
+                ESGData.calendar.Reset()
             return None
+        
+        if ESGData.calendar is not None:
+            line = ESGData.calendar.Sample(line)
+            if line is None:
+                return None
+        
+        if ESGData.store is not None:
+            index = ESGData.store.RowIndex(line)
+            if index is not None:
+                data.Time = ESGData.store.times[index]
+                data.Row = ESGData.store.Row(index)
+                data.Index = index
+                data.Value = float(data.Row.values[0])
+                return data
             
         split = line.split(';')
         
         data.Time = datetime.strptime(split[0], "%Y-%m-%d") + timedelta(days=1)
-
-        index = 1
-        for ticker in self.tickers:
-            data[ticker] = float(split[index])
-            index += 1
-            
-        data.Value = float(split[1])
+        data.Row = esg_store.ParseRow(ESGData.schema, split)
+        data.Value = float(data.Row.values[0])
         return data
 
 # References:
@@ -12,32 +12,44 @@
 # methods such as, for example, variance minimisation. 
 
 
-from datetime import datetime,timedelta
-import pandas as pd
-import numpy as np
+import k_data
 class PairedSwitching(QCAlgorithm):
     
     def Initialize(self):
         self.SetStartDate(2005,3,15)
         self.SetEndDate(2020,3,11)
         self.SetCash(100000)
+        # Decisions are made on daily closes, data is ingested at that resolution. timedelta - custom consolidated period.
+        self.decision_resolution = Resolution.Daily
+        self.feed = k_data.DecisionFeed(self, self.decision_resolution, self.OnDecisionBar)
         #we select two etfs that are negatively correlated; equity and bond etfs
-        self.first = self.AddEquity("SPY",Resolution.Minute)
-        self.second = self.AddEquity("AGG",Resolution.Minute)
+        self.first = self.feed.AddEquity("SPY")
+        self.second = self.feed.AddEquity("AGG")
         self.months = -1
+        # Lookback is counted in decision bars. Daily - 63 trading days ~ 90 calendar days, custom period has to be
+        # scaled by caller (63 daily bars ~ 32 two-day bars).
+        self.lookback = k_data.Parameter(self, 'lookback', 63)
+        self.price_cache = k_data.PriceCache(self.lookback)
+        
+        # Seed cache once with daily history so first rebalance has full lookback. Custom period cache is filled by feed only.
+        history = self.History([self.first.Symbol, self.second.Symbol], self.lookback + 1, Resolution.Daily) if self.decision_resolution == Resolution.Daily else None
+        if history is not None and not history.empty:
+            for security in [self.first, self.second]:
+                if security.Symbol.Value not in history.index.get_level_values(0): continue
+                bars = history.loc[security.Symbol.Value]
+                for time, close in zip(bars.index, bars["close"]):
+                    self.price_cache.Update(security.Symbol, time, close)
         #monthly scheduled event but rebalancing will run on quarterly basis
+        self.rebalance_months = k_data.Parameter(self, 'rebalance_months', 3)
         self.Schedule.On(self.DateRules.MonthStart("SPY"), self.TimeRules.AfterMarketOpen("SPY", 1), self.Rebalance)
 
     def Rebalance(self):
         self.months +=1
-        if(self.months%3==0):
+        if(self.months%self.rebalance_months==0):
             #retrieves prices from 90 days ago
-            history_call = self.History(self.Securities.Keys,timedelta(days=90))
-            if not history_call.empty:
-                first_bars = history_call.loc[self.first.Symbol.Value]
-                last_p1 = first_bars["close"].iloc[0]
-                second_bars = history_call.loc[self.second.Symbol.Value]
-                last_p2 = second_bars["close"].iloc[0]
+            last_p1 = self.price_cache.Close(self.first.Symbol, self.lookback)
+            last_p2 = self.price_cache.Close(self.second.Symbol, self.lookback)
+            if last_p1 is not None and last_p2 is not None:
                 # calculates performance of funds over the prior quarter
                 first_performance = (float(self.Securities[self.first.Symbol].Price) - float(last_p1))/(float(self.Securities[self.first.Symbol].Price))
                 second_performance = (float(self.Securities[self.second.Symbol].Price) - float(last_p2))/(float(self.Securities[self.second.Symbol].Price))
@@ -51,8 +63,11 @@ class PairedSwitching(QCAlgorithm):
                         self.Liquidate(self.first.Symbol)
                     self.SetHoldings(self.second.Symbol,1)
 
+    def OnDecisionBar(self, bar):
+        self.price_cache.Update(bar.Symbol, bar.EndTime, bar.Close)
+
     def OnData(self, data):
-        pass
+        self.feed.OnData(data)
 
 # References:
 # Maewal, Bock: Paired-Switching for Tactical Portfolio Allocation,
@@ -0,0 +1,306 @@
+# Synthetic-data benchmark of the ESG and rotation strategies. Strategies are replayed by local_engine over seeded
+# synthetic panels, hot callbacks are timed separately and results are written as JSON. Earlier result file can be
+# passed as baseline, callbacks slower than baseline by more than tolerance are reported as regressions.
+#
+# python benchmark.py --tickers 500 2000 --years 1 10 --out bench.json --baseline previous.json
+# python benchmark.py --tickers 500 --years 4 --check compares ESG signal and history paths, upper and lower case header.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import importlib
+import subprocess
+import numpy as np
+import pandas as pd
+import local_engine
+
+local_engine.Install()
+
+# module, algorithm class, timed methods of algorithm class
+STRATEGIES = [
+    ('esg_factors', 'ESGFactorInvestingStrategy', ['Selection', 'CoarseSelectionFunction', 'FineSelectionFunction', 'OnData']),
+    ('ESG_Momentum', 'ESGFactorMomentumStrategy', ['Selection', 'CoarseSelectionFunction', 'FineSelectionFunction', 'OnData']),
+    ('Rotational_Pair', 'PairedSwitching', ['Rebalance', 'OnData'])
+]
+
+# NOTE: Wall time of every call of patched methods. Methods are replaced on their classes for duration of run
+# and restored afterwards.
+class CallbackTimer():
+    def __init__(self):
+        self.samples = {}   # label -> list of seconds
+        self.patched = []   # (owner, name, original)
+
+    def Patch(self, owner, name, label):
+        original = owner.__dict__[name]
+        samples = self.samples.setdefault(label, [])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, original))
+
+    def Restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def Summary(self):
+        return { label : Summary(samples) for label, samples in self.samples.items() }
+
+def Summary(samples):
+    samples = np.asarray(samples, dtype = np.float64)
+    if len(samples) == 0:
+        return { 'calls' : 0, 'total' : 0., 'mean' : 0., 'p50' : 0., 'p95' : 0., 'max' : 0. }
+
+    return {
+        'calls' : len(samples),
+        'total' : float(samples.sum()),
+        'mean' : float(samples.mean()),
+        'p50' : float(np.percentile(samples, 50)),
+        'p95' : float(np.percentile(samples, 95)),
+        'max' : float(samples.max())
+    }
+
+# Trading days of `years` years ending 2019-12-31.
+def TradingDays(years):
+    end = pd.Timestamp(2019, 12, 31)
+    return pd.bdate_range(end - pd.DateOffset(years = years), end).values.astype('datetime64[D]')
+
+def SyntheticTickers(count):
+    return ['T%05d' % i for i in range(count)]
+
+# Geometric random walk closes. SPY and AGG are first two columns, negatively correlated through common factor.
+def SyntheticPrices(rng, tickers, dates):
+    tickers = ['SPY', 'AGG'] + tickers
+    factor = rng.normal(0, 0.008, (len(dates), 1)).astype(np.float32)
+    beta = rng.uniform(0.5, 1.5, len(tickers)).astype(np.float32)
+    beta[1] = -0.3
+
+    returns = factor * beta + rng.normal(0.0002, 0.012, (len(dates), len(tickers))).astype(np.float32)
+    close = np.cumprod(1 + returns, axis = 0, dtype = np.float32)
+    close *= rng.uniform(10, 200, len(tickers)).astype(np.float32)
+
+    # Late listings.
+    listing = rng.integers(0, max(len(dates) // 4, 1), len(tickers))
+    listing[:2] = 0
+    close[np.arange(len(dates))[:, None] < listing] = np.nan
+
+    volume = np.full(close.shape, 1e6, dtype = np.float32)
+    return local_engine.PricePanel(dates, tickers, close, volume)
+
+# Month start snapshots. Some names have non positive EPS and are screened out by fine selection.
+def SyntheticFundamentals(rng, tickers, dates):
+    months = np.unique(dates.astype('datetime64[M]')).astype('datetime64[D]')
+    shape = (len(months), len(tickers))
+
+    shares = np.exp(rng.normal(17, 1, len(tickers))) * np.exp(np.cumsum(rng.normal(0, 0.01, shape), axis = 0))
+    eps = rng.normal(2, 1.5, len(tickers)) + np.cumsum(rng.normal(0, 0.1, shape), axis = 0)
+    pe = rng.uniform(5, 40, shape)
+    return local_engine.FundamentalPanel(months, tickers, shares, eps, pe)
+
+# ESG decile file in source format. Two rows per month starting a year before first trading day, so first selection
+# has data. About 5 % of deciles change every row. lower = True writes header tickers in lower case.
+def WriteESGDeciles(rng, tickers, dates, path, lower = False):
+    months = np.arange(dates[0].astype('datetime64[M]') - 12, dates[-1].astype('datetime64[M]') + 1)
+    days = np.concatenate([months.astype('datetime64[D]') + 14, (months + 1).astype('datetime64[D]') - 3])
+    days.sort()
+    labels = np.array(['%.1f' % (x / 10) for x in range(11)], dtype = object)
+
+    deciles = rng.integers(0, 11, len(tickers))
+    with open(path, 'w') as f:
+        f.write('date;' + ';'.join(x.lower() if lower else x for x in tickers) + '\n')
+        for day in days:
+            changed = rng.random(len(tickers)) < 0.05
+            deciles[changed] = rng.integers(0, 11, int(changed.sum()))
+            f.write(str(day) + ';' + ';'.join(labels[deciles]) + '\n')
+
+# Synthetic data directory. store = True puts decile file where ESGStore.TryLoad finds it, otherwise only under
+# remote source path, so ESGData parses text.
+def Generate(tickers, years, seed, directory, store = True, lower = False):
+    rng = np.random.default_rng(seed)
+    dates = TradingDays(years)
+    names = SyntheticTickers(tickers)
+
+    prices = SyntheticPrices(rng, names, dates)
+    fundamentals = SyntheticFundamentals(rng, names, dates)
+
+    if store:
+        esg_path = os.path.join(directory, 'esg_deciles_data.csv')
+    else:
+        esg_path = os.path.join(directory, 'backtesting_data', 'economic', 'esg_deciles_data.csv')
+        os.makedirs(os.path.dirname(esg_path), exist_ok = True)
+    WriteESGDeciles(rng, names, dates, esg_path, lower)
+
+    return prices, fundamentals
+
+# Replays strategy and times its callbacks.
+def RunStrategy(module, algorithm, methods, prices, fundamentals, directory):
+    module = importlib.import_module(module)
+    algorithm_type = getattr(module, algorithm)
+
+    timer = CallbackTimer()
+    for method in methods:
+        timer.Patch(algorithm_type, method, method)
+    if hasattr(module, 'ESGData'):
+        timer.Patch(module.ESGData, 'Reader', 'ESGData.Reader')
+
+    # ESGStore is looked up relative to working directory.
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        start = time.perf_counter()
+        result = local_engine.LocalEngine(prices, fundamentals, directory, local_engine.Datetime(prices.dates[0]), local_engine.Datetime(prices.dates[-1])).Run(algorithm_type)
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        timer.Restore()
+
+    return {
+        'wall' : wall,
+        'callbacks' : timer.Summary(),
+        'statistics' : result.Statistics()
+    }
+
+# opt_portfolio on synthetic daily returns of `assets` assets, `solves` times.
+def RunOptimizer(rng, assets, solves = 3, days = 252):
+    import k_data
+
+    returns = pd.DataFrame(rng.normal(0.0004, 0.01, (days, assets)) + rng.normal(0, 0.005, (days, 1)))
+    optimizer = k_data.PortfolioOptimization(returns, 0.01, assets)
+
+    timer = CallbackTimer()
+    timer.Patch(k_data.PortfolioOptimization, 'opt_portfolio', 'PortfolioOptimization.opt_portfolio')
+    try:
+        for i in range(solves):
+            optimizer.opt_portfolio()
+    finally:
+        timer.Restore()
+
+    return { 'callbacks' : timer.Summary() }
+
+# Runs all strategies for every (tickers, years) size.
+def Benchmark(sizes, seed = 0, optimizer_assets = 100, store = True, strategies = STRATEGIES):
+    runs = []
+    for tickers, years in sizes:
+        directory = tempfile.mkdtemp(prefix = 'benchmark_')
+        try:
+            prices, fundamentals = Generate(tickers, years, seed, directory, store)
+            # Rotation only trades SPY and AGG.
+            pair = local_engine.PricePanel(prices.dates, prices.tickers[:2], prices.close[:, :2], prices.volume[:, :2])
+
+            for module, algorithm, methods in strategies:
+                panel = pair if module == 'Rotational_Pair' else prices
+                run = RunStrategy(module, algorithm, methods, panel, fundamentals, directory)
+                run.update({ 'strategy' : algorithm, 'tickers' : tickers, 'years' : years, 'seed' : seed })
+                runs.append(run)
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    run = RunOptimizer(np.random.default_rng(seed), optimizer_assets)
+    run.update({ 'strategy' : 'PortfolioOptimization', 'tickers' : optimizer_assets, 'years' : 1, 'seed' : seed })
+    runs.append(run)
+
+    return {
+        'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit' : Commit(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'machine' : platform.machine(),
+        'runs' : runs
+    }
+
+# Replays ESG strategies once from columnar store (precomputed signals) and once from text (history), with upper and
+# lower case header. Both paths have to give the same statistics.
+def Check(sizes, seed = 0, strategies = STRATEGIES):
+    checks = []
+    for tickers, years in sizes:
+        for lower in [False, True]:
+            statistics = {}
+            for store in [True, False]:
+                directory = tempfile.mkdtemp(prefix = 'benchmark_')
+                try:
+                    prices, fundamentals = Generate(tickers, years, seed, directory, store, lower)
+                    for module, algorithm, methods in strategies:
+                        if module == 'Rotational_Pair': continue
+                        statistics[(algorithm, store)] = RunStrategy(module, algorithm, [], prices, fundamentals, directory)['statistics']
+                finally:
+                    shutil.rmtree(directory, ignore_errors = True)
+
+            for algorithm in sorted(set(x[0] for x in statistics)):
+                signals, history = statistics[(algorithm, True)], statistics[(algorithm, False)]
+                checks.append({ 'strategy' : algorithm, 'tickers' : tickers, 'years' : years, 'lower' : lower,
+                    'signal_orders' : signals['orders'], 'history_orders' : history['orders'], 'equal' : signals == history })
+    return checks
+
+def Commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Callbacks with mean time above baseline by more than tolerance. Callbacks faster than min_time in both runs are noise.
+def Compare(current, baseline, tolerance = 0.25, min_time = 1e-4):
+    previous = {}
+    for run in baseline['runs']:
+        for label, summary in run['callbacks'].items():
+            previous[(run['strategy'], run['tickers'], run['years'], label)] = summary
+
+    regressions = []
+    for run in current['runs']:
+        for label, summary in run['callbacks'].items():
+            key = (run['strategy'], run['tickers'], run['years'], label)
+            if key not in previous: continue
+
+            before = previous[key]['mean']
+            after = summary['mean']
+            if max(before, after) < min_time: continue
+            if after > before * (1 + tolerance):
+                regressions.append({ 'strategy' : key[0], 'tickers' : key[1], 'years' : key[2], 'callback' : label,
+                    'baseline' : before, 'current' : after, 'ratio' : after / before if before > 0 else float('inf') })
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickers', type = int, nargs = '+', default = [500])
+    parser.add_argument('--years', type = int, nargs = '+', default = [1, 10])
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--optimizer-assets', type = int, default = 100)
+    parser.add_argument('--text', action = 'store_true', help = 'parse ESG text instead of columnar store')
+    parser.add_argument('--out', default = 'benchmark.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--check', action = 'store_true', help = 'compare signal and history paths instead of timing')
+    args = parser.parse_args()
+
+    sizes = [(tickers, years) for tickers in args.tickers for years in args.years]
+    if args.check:
+        checks = Check(sizes, args.seed)
+        for x in checks:
+            print('%s %s tickers=%d years=%d header=%s orders=%d/%d' % ('OK' if x['equal'] else 'MISMATCH', x['strategy'], x['tickers'], x['years'], 'lower' if x['lower'] else 'upper', x['signal_orders'], x['history_orders']))
+        sys.exit(0 if all(x['equal'] for x in checks) else 1)
+
+    result = Benchmark(sizes, args.seed, args.optimizer_assets, not args.text)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent = 1)
+
+    for run in result['runs']:
+        print('%s tickers=%d years=%d' % (run['strategy'], run['tickers'], run['years']))
+        for label, summary in run['callbacks'].items():
+            print('  %-40s calls=%-6d total=%.4fs mean=%.6fs p95=%.6fs' % (label, summary['calls'], summary['total'], summary['mean'], summary['p95']))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = Compare(result, json.load(f), args.tolerance)
+        for x in regressions:
+            print('REGRESSION %s tickers=%d years=%d %s %.6fs -> %.6fs' % (x['strategy'], x['tickers'], x['years'], x['callback'], x['baseline'], x['current']))
+        sys.exit(1 if len(regressions) != 0 else 0)
@@ -1,5 +1,6 @@
 import k_data
-from collections import deque
+import esg_store
+import numpy as np
 
 class ESGFactorInvestingStrategy(QCAlgorithm):
 
@@ -13,32 +14,48 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         # Decile weighting.
         # True - Value weighted
         # False - Equally weighted
-        self.value_weighting = True
+        self.value_weighting = k_data.Parameter(self, 'value_weighting', True)
         
 
         self.symbol = 'SPY'
         self.AddEquity(self.symbol, Resolution.Daily)
         
+        # Columnar ESG cache is used when local copy of the decile file exists.
+        ESGData.store = esg_store.ESGStore.TryLoad()
+        # ESG rows are consumed only at month start selection. None - emit every row.
+        ESGData.calendar = esg_store.SamplingCalendar(esg_store.MonthStarts(self.StartDate, self.EndDate, self.Securities[self.symbol].Exchange.Hours.IsDateOpen))
         self.esg_data = self.AddData(ESGData, 'ESG', Resolution.Daily)
+        # Signals precomputed over whole store. Looked up by position of current row, None - computed from history.
+        self.signals = esg_store.ESGSignals(ESGData.store, ESGData.calendar) if ESGData.store is not None else None
+        self.signal_position = None
         
         # All tickers from ESG database.
-        self.tickers = []
+        self.universe = None
         
-        self.ticker_deciles = {}
+        self.ticker_deciles = None
         
-        self.holding_period = 12
-        self.managed_queue = deque(maxlen = self.holding_period + 1)
+        # ESG decile thresholds of long and short leg.
+        self.long_threshold = k_data.Parameter(self, 'long_threshold', 0.8)
+        self.short_threshold = k_data.Parameter(self, 'short_threshold', 0.2)
+        
+        self.holding_period = k_data.Parameter(self, 'holding_period', 12)
+        self.tranche_book = k_data.TrancheBook(self.holding_period + 1)
+        self.rebalancer = k_data.TargetRebalancer(self)
         
         self.selection_flag = False
         self.rebalance_flag = False
+        # Previous selection. Fee model is shared by all securities.
+        self.universe_tracker = k_data.UniverseTracker()
+        self.fee_model = k_data.CustomFeeModel(self)
         self.UniverseSettings.Resolution = Resolution.Daily
         self.AddUniverse(self.CoarseSelectionFunction, self.FineSelectionFunction)
         
         self.Schedule.On(self.DateRules.MonthStart(self.symbol), self.TimeRules.AfterMarketOpen(self.symbol), self.Selection)
     
     def OnSecuritiesChanged(self, changes):
+        # AddedSecurities is already the delta against previous selection. Fee model instance is shared.
         for security in changes.AddedSecurities:
-            security.SetFeeModel(k_data.CustomFeeModel(self))
+            security.SetFeeModel(self.fee_model)
     
     def CoarseSelectionFunction(self, coarse):
         if not self.selection_flag:
@@ -46,7 +63,7 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         
         self.selection_flag = False
         
-        selected = [x.Symbol for x in coarse if (x.Symbol.Value).lower() in self.tickers]
+        selected = [x.Symbol for x in coarse if x.Symbol.Value in self.universe]
 
         return selected
     
@@ -55,29 +72,25 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
 
         self.rebalance_flag = True
         
-        # Store symbol/market cap pair.
-        long = [[x.Symbol, (x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio))]
-                            for x in fine if (x.Symbol.Value in self.ticker_deciles) and                                                       \
-                                                (len(self.ticker_deciles[x.Symbol.Value]) == self.ticker_deciles[x.Symbol.Value].maxlen) and    \
-                                                (self.ticker_deciles[x.Symbol.Value][0] != 0) and                                               \
-                                                (self.ticker_deciles[x.Symbol.Value][0] >= 0.8) and                                             \
-                                                not self.IsInvested(x.Symbol)]
+        tickers = [x.Symbol.Value for x in fine]
+        invested = np.array([self.IsInvested(x.Symbol) for x in fine], dtype = bool)
+        market_caps = np.array([x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio) for x in fine], dtype = np.float64)
         
-        short = [[x.Symbol, (x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio))]
-                            for x in fine if (x.Symbol.Value in self.ticker_deciles) and                                                      \
-                                                (len(self.ticker_deciles[x.Symbol.Value]) == self.ticker_deciles[x.Symbol.Value].maxlen) and    \
-                                                (self.ticker_deciles[x.Symbol.Value][0] != 0) and                                               \
-                                                (self.ticker_deciles[x.Symbol.Value][0] <= 0.2) and                                             \
-                                                not self.IsInvested(x.Symbol)]
-
-        if len(long + short) == 0: 
-            # Store empty item.
-            self.managed_queue.append(RebalanceQueueItem([], []))
-            return []
+        # ESG deciles of last two months. Oldest one is used for selection.
+        if self.signal_position is not None:
+            flags = self.signals.Gather(self.signals.Flags(self.ticker_deciles.period - 1, self.long_threshold, self.short_threshold), self.signal_position, tickers)
+            long_index, short_index = k_data.FlagLegs(flags, self.ticker_deciles.IsReady(), invested)
+        else:
+            deciles, ready = self.ticker_deciles.Gather(tickers, self.ticker_deciles.period - 1)
+            long_index, short_index = k_data.ScreenLegs(deciles, ready, invested, self.long_threshold, self.short_threshold)
         
-        self.managed_queue.append(RebalanceQueueItem(long, short))
+        # New tranche. Empty one is stored too.
+        long_symbols = [fine[i].Symbol for i in long_index]
+        short_symbols = [fine[i].Symbol for i in short_index]
+        long_weights, short_weights = k_data.TrancheWeights(market_caps[long_index], market_caps[short_index], self.holding_period, self.value_weighting)
+        self.tranche_book.Append(long_symbols, long_weights, short_symbols, short_weights)
 
-        return [x[0] for x in long + short]
+        return self.universe_tracker.Select(long_symbols + short_symbols)
 
     def OnData(self, data):
         if not self.rebalance_flag:
@@ -85,68 +98,59 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         self.rebalance_flag = False
 
         # Trade execution.
-        if len(self.managed_queue) == 0: return
+        if len(self.tranche_book) == 0: return
 
-        # Liquidate first items if queue is full.
-        if len(self.managed_queue) == self.managed_queue.maxlen:
-            item_to_liquidate = self.managed_queue.popleft()
-            for symbol, market_cap in item_to_liquidate.long_symbols + item_to_liquidate.short_symbols:
-                self.Liquidate(symbol)
+        # Roll off oldest tranche if book is full.
+        expired = self.tranche_book.PopOldest() if self.tranche_book.IsFull() else None
         
-        curr_stock_set = self.managed_queue[-1]
-        if curr_stock_set.count == 0: return
+        newest = self.tranche_book.Newest()
+        if newest.count == 0 and (expired is None or expired.count == 0): return
         
-        # Open new trades.
-        if self.value_weighting:
-            weight = 1 / (self.holding_period * 2)
-            
-            total_market_cap_long = sum([x[1] for x in curr_stock_set.long_symbols])
-            for symbol, market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight * (market_cap / total_market_cap_long))
-                
-            total_market_cap_short = sum([x[1] for x in curr_stock_set.short_symbols])
-            for symbol, market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight * (market_cap / total_market_cap_short))
-        else:
-            weight = 1 / (self.holding_period * curr_stock_set.count)
-            
-            # Equally weighted.
-            for symbol, market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight)
-            for symbol, market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight)
+        # Trade to netted weights of all live tranches. Symbols held in several tranches are not liquidated and bought back.
+        self.rebalancer.Rebalance(self.tranche_book.NetExposure())
 
     def Selection(self):
         # Store universe tickers.
-        if len(self.tickers) == 0:
-            self.tickers = [x.Key for x in self.esg_data.GetLastData().GetStorageDictionary()]
+        data = self.esg_data.GetLastData()
+        row = data.Row
+        if self.universe is None:
+            self.universe = k_data.TickerIndex(row.schema.tickers)
+        
+        # Position of current row in precomputed signals.
+        self.signal_position = self.signals.Track(data.Index, 2) if self.signals is not None else None
 
         self.selection_flag = True
         
         # Store history for every ticker.
-        for ticker in self.tickers:
-            ticker_u = ticker.upper()
-            if ticker_u not in self.ticker_deciles:
-                self.ticker_deciles[ticker_u] = deque(maxlen = 2)
-                
-            decile = self.esg_data.GetLastData()[ticker]
-            self.ticker_deciles[ticker_u].append(decile)
+        if self.ticker_deciles is None:
+            self.ticker_deciles = k_data.CrossSectionHistory(self.universe, 2)
+        self.ticker_deciles.Append(row.values)
             
     def IsInvested(self, symbol):
         return self.Securities.ContainsKey(symbol) and self.Portfolio[symbol].Invested
 
-class RebalanceQueueItem():
-    def __init__(self, long_symbols, short_symbols):
-        self.long_symbols = long_symbols
-        self.short_symbols = short_symbols
-        self.count = len(long_symbols + short_symbols)
-        
+    # Signal panels used by FineSelectionFunction. Called by parameter sweep before runs are fanned out.
+    def PrecomputeSignals(self):
+        if self.signals is not None:
+            # Older of two stored months.
+            self.signals.Precompute(flags = [(1, self.long_threshold, self.short_threshold)])
+
 # ESG data.
 class ESGData(PythonData):
+    # Optional esg_store.ESGStore. Rows are served as views into it instead of parsing text.
+    store = None
+    # Ticker schema shared by all rows.
+    schema = None
+    # Optional esg_store.SamplingCalendar. Rows off the calendar are skipped unparsed.
+    calendar = None
+    
     def __init__(self):
-        self.tickers = []
+        self.Row = None
+        self.Index = None   # store row, None if parsed from text
     
     def GetSource(self, config, date, isLiveMode):
+        if ESGData.store is not None:
+            return SubscriptionDataSource(ESGData.store.source_path, SubscriptionTransportMedium.LocalFile, FileFormat.Csv)
         return SubscriptionDataSource("data.quantpedia.com/backtesting_data/economic/esg_deciles_data.csv", SubscriptionTransportMedium.RemoteFile, FileFormat.Csv)
     
     def Reader(self, config, line, date, isLiveMode):
@@ -154,19 +158,30 @@ class ESGData(PythonData):
         data.Symbol = config.Symbol
         
         if not line[0].isdigit():
-            self.tickers = [x for x in line.split(';')][1:]
+            ESGData.schema = esg_store.Schema(line.split(';')[1:])
+            if ESGData.calendar is not None:
+                ESGData.calendar.Reset()
             return None
+        
+        if ESGData.calendar is not None:
+            line = ESGData.calendar.Sample(line)
+            if line is None:
+                return None
+        
+        if ESGData.store is not None:
+            index = ESGData.store.RowIndex(line)
+            if index is not None:
+                data.Time = ESGData.store.times[index]
+                data.Row = ESGData.store.Row(index)
+                data.Index = index
+                data.Value = float(data.Row.values[0])
+                return data
             
         split = line.split(';')
         
         data.Time = datetime.strptime(split[0], "%Y-%m-%d") + timedelta(days=1)
-        
-        index = 1
-        for ticker in self.tickers:
-            data[ticker] = float(split[index])
-            index += 1
-            
-        data.Value = float(split[1])
+        data.Row = esg_store.ParseRow(ESGData.schema, split)
+        data.Value = float(data.Row.values[0])
         return data
 
 
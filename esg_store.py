@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+from datetime import datetime, timedelta
+
+# Default local copy of data.quantpedia.com/backtesting_data/economic/esg_deciles_data.csv
+ESG_DECILES_PATH = 'esg_deciles_data.csv'
+
+# NOTE: Columnar cache of the ESG decile file. Source csv is converted once into date x ticker float32 matrix
+# stored as raw binary next to the source and memory-mapped on later runs. Cache is rebuilt when source file changes.
+class ESGStore():
+    def __init__(self, source_path, keys, tickers, values, source_hash):
+        self.source_path = source_path
+        self.keys = keys                # date strings as they appear in the source file
+        self.schema = Schema(tickers)   # shared ticker schema in column order
+        self.tickers = self.schema.tickers
+        self.values = values            # date x ticker float32 matrix
+        self.source_hash = source_hash  # sha1 of source file at conversion time
+
+        # Date string -> row index.
+        self.row_index = { key : index for index, key in enumerate(keys) }
+
+        # Data time is shifted by one day as in ESGData.Reader.
+        self.times = [datetime.strptime(key, "%Y-%m-%d") + timedelta(days=1) for key in keys]
+
+    @staticmethod
+    def Load(source_path, cache_dir = None):
+        paths = CachePaths(source_path, cache_dir)
+        signature = SourceSignature(source_path)
+
+        meta = None
+        if os.path.exists(paths['meta']):
+            with open(paths['meta']) as f:
+                meta = json.load(f)
+            if meta['signature'] != signature:
+                meta = None
+
+        # Convert source on first use or if it has changed.
+        if meta is None:
+            meta = Convert(source_path, paths, signature)
+
+        shape = (len(meta['keys']), len(meta['tickers']))
+        if shape[0] == 0 or shape[1] == 0:
+            values = np.zeros(shape, dtype = np.float32)
+        else:
+            values = np.memmap(paths['values'], dtype = np.float32, mode = 'r', shape = shape)
+
+        return ESGStore(source_path, meta['keys'], meta['tickers'], values, meta['sha1'])
+
+    # Returns store if local copy of source exists, None otherwise.
+    @staticmethod
+    def TryLoad(source_path = ESG_DECILES_PATH, cache_dir = None):
+        if not os.path.exists(source_path):
+            return None
+        return ESGStore.Load(source_path, cache_dir)
+
+    # Row index for raw csv line. Only date column is inspected.
+    def RowIndex(self, line):
+        return self.row_index.get(line[:line.find(';')])
+
+    # Zero-copy view of row values.
+    def Row(self, index):
+        return ESGRow(self.schema, self.values[index])
+
+# NOTE: Ticker schema shared by all ESG rows. Ticker strings are interned once per distinct header,
+# rows only carry a contiguous value buffer.
+class ESGSchema():
+    __slots__ = ('tickers', 'index')
+
+    def __init__(self, tickers):
+        self.tickers = [sys.intern(x) for x in tickers]
+        self.index = { ticker : index for index, ticker in enumerate(self.tickers) }
+
+    def __len__(self):
+        return len(self.tickers)
+
+class ESGRow():
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema    # ESGSchema
+        self.values = values    # float32 array in schema order
+
+    def __getitem__(self, ticker):
+        return self.values[self.schema.index[ticker]]
+
+    def __contains__(self, ticker):
+        return ticker in self.schema.index
+
+    def __len__(self):
+        return len(self.values)
+
+# NOTE: Sampling calendar for ESGData. Only the last row before each scheduled date is emitted, other lines are
+# skipped on the date column alone. Emitted row is held back until the first line past the scheduled date is seen.
+# Rows are dated one day before they become visible, so the row emitted for a scheduled date is the last row
+# Selection would see on that date without sampling.
+class SamplingCalendar():
+    def __init__(self, dates = None):
+        # Explicit rebalance dates, e.g. MonthStarts of exchange. None - every calendar month start, differs from
+        # MonthStart schedule when rows are dated between the 1st and first trading day of month.
+        self.boundaries = None if dates is None else sorted(x.strftime("%Y-%m-%d") for x in dates)
+        self.Reset()
+
+    def Reset(self):
+        self.pending = None
+        self.position = 0
+
+    # Feeds raw csv line. Returns line to emit or None.
+    def Sample(self, line):
+        pending = self.pending
+        self.pending = line
+        if pending is None: return None
+
+        key = line[:line.find(';')]
+        pending_key = pending[:pending.find(';')]
+
+        if self.boundaries is None:
+            return pending if key[:7] != pending_key[:7] else None
+
+        boundaries = self.boundaries
+        position = self.position
+        while position < len(boundaries) and boundaries[position] <= pending_key:
+            position += 1
+        self.position = position
+
+        if position < len(boundaries) and boundaries[position] <= key:
+            return pending
+        return None
+
+# First trading day of every month between start and end, dates of DateRules.MonthStart. is_open - date -> bool,
+# e.g. IsDateOpen of security exchange hours.
+def MonthStarts(start, end, is_open):
+    starts = []
+    month = datetime(start.year, start.month, 1)
+    while month <= end:
+        following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        day = month
+        while day < following and not is_open(day):
+            day += timedelta(days=1)
+        if day < following and start <= day <= end:
+            starts.append(day)
+        month = following
+    return starts
+
+# Flag bits of decile screen signal.
+LONG_FLAG = 1
+SHORT_FLAG = 2
+
+# NOTE: Precomputed ESG signals. Store rows are sampled as by SamplingCalendar, so sample position k is the k-th row
+# a strategy appends to its history. Every signal is a sample x ticker panel computed for the whole store at once and
+# cached on disk under the source hash and its parameters. Strategies look signal up by position of current row.
+class ESGSignals():
+    def __init__(self, store, calendar = None, cache_dir = None):
+        self.store = store
+        self.cache_dir = cache_dir
+        self.boundaries = calendar.boundaries if calendar is not None else None
+        self.sampled = calendar is not None
+
+        # Store rows emitted by calendar, None - every row.
+        self.rows = SampleRows(store.keys, self.boundaries) if self.sampled else np.arange(len(store.keys))
+        self.position = { row : position for position, row in enumerate(self.rows.tolist()) }
+        self.samples = np.asarray(store.values)[self.rows]
+        self.panels = {}
+
+        # Header ticker -> column. Normalized to upper case as by k_data.TickerIndex, first column of duplicate wins.
+        self.columns = {}
+        for column, ticker in enumerate(store.tickers):
+            self.columns.setdefault(ticker.upper(), column)
+
+        # Last tracked position and number of consecutive positions ending with it.
+        self.last = None
+        self.run = 0
+
+    # Sample position of store row or None if row is off calendar.
+    def Position(self, index):
+        return self.position.get(index)
+
+    # Position of row appended to strategy history. Panel lags count samples, so position is returned only if last
+    # `span` appended rows were consecutive samples. Otherwise (month without new row appends previous row again)
+    # None is returned and history is used.
+    def Track(self, index, span):
+        position = self.position.get(index) if index is not None else None
+        if position is not None and self.last is not None and position == self.last + 1:
+            self.run += 1
+        else:
+            self.run = 1 if position is not None else 0
+        self.last = position
+        return position if self.run >= span else None
+
+    # Values of tickers at sample position. Missing tickers get `missing`.
+    def Gather(self, panel, position, tickers, missing = 0):
+        columns = np.fromiter((self.columns.get(ticker, -1) for ticker in tickers), dtype = np.int64, count = len(tickers))
+        found = columns != -1
+        return np.where(found, panel[position][np.where(found, columns, 0)], missing)
+
+    # Decile momentum between `recent` and `past` samples ago. NaN where any decile is zero or missing.
+    def Momentum(self, recent, past, ratio = True):
+        return self.Signal('momentum', [recent, past, ratio], lambda: MomentumPanel(self.samples, recent, past, ratio))
+
+    # Decile screen of sample `lag` samples ago. LONG_FLAG and SHORT_FLAG bits, zero deciles are never flagged.
+    def Flags(self, lag, long_threshold, short_threshold):
+        return self.Signal('flags', [lag, long_threshold, short_threshold], lambda: FlagPanel(self.samples, lag, long_threshold, short_threshold))
+
+    # Offline stage. Computes and caches all signal variants.
+    def Precompute(self, momentum = (), flags = ()):
+        for recent, past, ratio in momentum:
+            self.Momentum(recent, past, ratio)
+        for lag, long_threshold, short_threshold in flags:
+            self.Flags(lag, long_threshold, short_threshold)
+
+    def Signal(self, name, params, compute):
+        key = SignalKey(self.store.source_hash, name, params, self.sampled, self.boundaries)
+        if key in self.panels:
+            return self.panels[key]
+
+        path = CachePaths(self.store.source_path, self.cache_dir)['signal'].format(key)
+        if os.path.exists(path):
+            panel = np.load(path, mmap_mode = 'r')
+        else:
+            panel = compute()
+            tmp_path = TempPath(path)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, panel)
+            os.replace(tmp_path, path)
+
+        self.panels[key] = panel
+        return panel
+
+schemas = {}
+
+# Interned schema for header tickers.
+def Schema(tickers):
+    key = tuple(tickers)
+    if key not in schemas:
+        schemas[key] = ESGSchema(tickers)
+    return schemas[key]
+
+# Row parsed from raw csv line values into single float32 buffer.
+def ParseRow(schema, split):
+    return ESGRow(schema, np.array(split[1:], dtype = np.float32))
+
+def CachePaths(source_path, cache_dir = None):
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(source_path))
+    base = os.path.join(cache_dir, os.path.basename(source_path))
+
+    return {
+        'meta' : base + '.meta.json',
+        'values' : base + '.f32',
+        'signal' : base + '.signal.{0}.npy'
+    }
+
+# Store rows emitted by SamplingCalendar with given boundaries. Last row is never emitted.
+def SampleRows(keys, boundaries = None):
+    if len(keys) < 2:
+        return np.zeros(0, dtype = np.int64)
+
+    keys = np.array(keys)
+    if boundaries is None:
+        months = keys.astype('U7')
+        return np.flatnonzero(months[1:] != months[:-1])
+
+    boundaries = np.array(boundaries)
+    following = np.searchsorted(boundaries, keys[:-1], 'right')
+    crossed = following < len(boundaries)
+    crossed[crossed] = boundaries[following[crossed]] <= keys[1:][crossed]
+    return np.flatnonzero(crossed)
+
+def SignalKey(source_hash, name, params, sampled, boundaries):
+    description = json.dumps([source_hash, name, params, sampled, boundaries])
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+# Momentum ratio (or difference) of samples as in k_data.RankMomentum, computed in float64.
+def MomentumPanel(samples, recent, past, ratio = True):
+    panel = np.full(samples.shape, np.nan)
+    count = len(samples) - past
+    if count <= 0:
+        return panel
+
+    recent_values = samples[past - recent:past - recent + count].astype(np.float64)
+    past_values = samples[:count].astype(np.float64)
+    valid = (recent_values != 0) & (past_values != 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        scores = recent_values / past_values - 1 if ratio else recent_values - past_values
+    panel[past:] = np.where(valid, scores, np.nan)
+    return panel
+
+# Decile screen as in k_data.ScreenLegs. Thresholds are compared in precision of deciles.
+def FlagPanel(samples, lag, long_threshold, short_threshold):
+    panel = np.zeros(samples.shape, dtype = np.int8)
+    if len(samples) <= lag:
+        return panel
+
+    deciles = samples[:len(samples) - lag]
+    nonzero = deciles != 0
+    panel[lag:] = np.where(nonzero & (deciles >= deciles.dtype.type(long_threshold)), LONG_FLAG, 0) | np.where(nonzero & (deciles <= deciles.dtype.type(short_threshold)), SHORT_FLAG, 0)
+    return panel
+
+def SourceSignature(source_path):
+    stat = os.stat(source_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def FileHash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# Per process temporary path. Concurrent writers of the same cache file do not clobber each other.
+def TempPath(path):
+    return '%s.%d.tmp' % (path, os.getpid())
+
+# One-time csv -> binary conversion.
+def Convert(source_path, paths, signature):
+    keys = []
+    tickers = []
+    rows = []
+
+    with open(source_path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0: continue
+
+            split = line.split(';')
+            if not line[0].isdigit():
+                tickers = split[1:]
+                continue
+
+            keys.append(split[0])
+            rows.append(split[1:])
+
+    values = np.array(rows, dtype = np.float32).reshape(len(keys), len(tickers))
+
+    # Write values first, metadata last. Metadata presence marks valid cache.
+    tmp_path = TempPath(paths['values'])
+    values.tofile(tmp_path)
+    os.replace(tmp_path, paths['values'])
+
+    meta = {
+        'signature' : signature,
+        'sha1' : FileHash(source_path),
+        'keys' : keys,
+        'tickers' : tickers
+    }
+    tmp_path = TempPath(paths['meta'])
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, paths['meta'])
+
+    return meta
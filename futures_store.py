@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import numpy as np
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from esg_store import TempPath
+
+# Default directory with local copies of data.quantpedia.com/backtesting_data/futures/<symbol>.csv
+FUTURES_DIR = 'futures'
+
+# NOTE: Columnar store of many QuantpediaFutures files. Sources are parsed concurrently into common date index and
+# date x symbol settle matrix (NaN where symbol has no quote). Result is written as raw binary and memory-mapped on
+# later runs. Cache is keyed by symbol set and rebuilt when any source file changes.
+class FuturesStore():
+    def __init__(self, source_dir, symbols, days, settle, source_hash):
+        self.source_dir = source_dir
+        self.symbols = symbols          # column order
+        self.days = days                # int32 days since 1970-01-01, ascending
+        self.settle = settle            # date x symbol float64 matrix
+        self.source_hash = source_hash  # sha1 over source files at conversion time
+
+        self.column = { symbol : index for index, symbol in enumerate(symbols) }
+        self.dates = days.astype('datetime64[D]')
+
+        # Date string as it appears in source files -> row index.
+        self.row_index = { FormatDate(day) : index for index, day in enumerate(self.dates.tolist()) }
+
+        # Data time is shifted by one day as in QuantpediaFutures.Reader.
+        self.times = [datetime(x.year, x.month, x.day) + timedelta(days=1) for x in self.dates.tolist()]
+
+    @staticmethod
+    def Load(symbols, source_dir = FUTURES_DIR, cache_dir = None, threads = None):
+        symbols = list(symbols)
+        sources = [SourcePath(source_dir, x) for x in symbols]
+        paths = CachePaths(source_dir, symbols, cache_dir)
+        signature = [SourceSignature(x) for x in sources]
+
+        meta = None
+        if os.path.exists(paths['meta']):
+            with open(paths['meta']) as f:
+                meta = json.load(f)
+            if meta['signature'] != signature:
+                meta = None
+
+        # Convert sources on first use or if any of them has changed.
+        if meta is None:
+            meta = Convert(sources, symbols, paths, signature, threads)
+
+        shape = (meta['rows'], len(symbols))
+        if shape[0] == 0 or shape[1] == 0:
+            days = np.zeros(shape[0], dtype = np.int32)
+            settle = np.zeros(shape, dtype = np.float64)
+        else:
+            days = np.fromfile(paths['days'], dtype = np.int32)
+            settle = np.memmap(paths['settle'], dtype = np.float64, mode = 'r', shape = shape)
+
+        return FuturesStore(source_dir, symbols, days, settle, meta['sha1'])
+
+    # Returns store of symbols with local copy, None if there is none.
+    @staticmethod
+    def TryLoad(symbols, source_dir = FUTURES_DIR, cache_dir = None, threads = None):
+        symbols = [x for x in symbols if os.path.exists(SourcePath(source_dir, x))]
+        if len(symbols) == 0:
+            return None
+        return FuturesStore.Load(symbols, source_dir, cache_dir, threads)
+
+    # Row index for raw csv line. Only date column is inspected.
+    def RowIndex(self, line):
+        return self.row_index.get(line[:line.find(';')])
+
+    def Settle(self, symbol, index):
+        return float(self.settle[index, self.column[symbol]])
+
+    # Quoted dates and settle prices of one symbol.
+    def Series(self, symbol):
+        values = self.settle[:, self.column[symbol]]
+        quoted = ~np.isnan(values)
+        return self.dates[quoted], np.asarray(values[quoted])
+
+def SourcePath(source_dir, symbol):
+    return os.path.join(source_dir, symbol + '.csv')
+
+# Fast "%d.%m.%Y" parser for single date string.
+def ParseDate(text):
+    if len(text) != 10:
+        # Not zero padded.
+        return datetime.strptime(text, "%d.%m.%Y")
+    return datetime(int(text[6:10]), int(text[3:5]), int(text[0:2]))
+
+def FormatDate(date):
+    return '%02d.%02d.%04d' % (date.day, date.month, date.year)
+
+# Vectorized "%d.%m.%Y" parser. Returns int32 days since 1970-01-01.
+def ParseDates(texts):
+    if len(texts) == 0:
+        return np.zeros(0, dtype = np.int32)
+
+    raw = np.array(texts, dtype = 'S10')
+    if np.any(np.char.str_len(raw) != 10):
+        # Not zero padded, fall back to scalar parsing.
+        return np.array([datetime.strptime(x, "%d.%m.%Y").toordinal() for x in texts], dtype = np.int32) - datetime(1970, 1, 1).toordinal()
+
+    digits = raw.view(np.uint8).reshape(len(raw), 10).astype(np.int32) - ord('0')
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 3] * 10 + digits[:, 4]
+    year = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    return (months.astype('datetime64[D]').astype(np.int64) + day - 1).astype(np.int32)
+
+# Dates and settle prices of one source file.
+def ParseFile(source_path):
+    dates = []
+    settle = []
+    with open(source_path) as f:
+        for line in f:
+            if len(line) == 0 or not line[0].isdigit(): continue
+            split = line.split(';', 2)
+            dates.append(split[0])
+            settle.append(split[1])
+
+    return ParseDates(dates), np.array(settle, dtype = np.float64)
+
+def CachePaths(source_dir, symbols, cache_dir = None):
+    if cache_dir is None:
+        cache_dir = source_dir
+    key = hashlib.sha1(';'.join(symbols).encode()).hexdigest()[:16]
+    base = os.path.join(cache_dir, 'futures_' + key)
+
+    return {
+        'meta' : base + '.meta.json',
+        'days' : base + '.days.i4',
+        'settle' : base + '.settle.f64'
+    }
+
+def SourceSignature(source_path):
+    stat = os.stat(source_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def FileHash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# One-time csv -> binary conversion. Files are parsed concurrently, settle matrix is filled column by column.
+def Convert(sources, symbols, paths, signature, threads = None):
+    with ThreadPoolExecutor(threads) as pool:
+        parsed = list(pool.map(ParseFile, sources))
+
+    if len(parsed) != 0:
+        days = np.unique(np.concatenate([x[0] for x in parsed])).astype(np.int32)
+    else:
+        days = np.zeros(0, dtype = np.int32)
+
+    # Write values first, metadata last. Metadata presence marks valid cache.
+    tmp_path = TempPath(paths['settle'])
+    if len(days) != 0 and len(symbols) != 0:
+        settle = np.memmap(tmp_path, dtype = np.float64, mode = 'w+', shape = (len(days), len(symbols)))
+        settle[:] = np.nan
+        for column, (dates, values) in enumerate(parsed):
+            settle[np.searchsorted(days, dates), column] = values
+        settle.flush()
+        del settle
+        os.replace(tmp_path, paths['settle'])
+
+    tmp_path = TempPath(paths['days'])
+    days.tofile(tmp_path)
+    os.replace(tmp_path, paths['days'])
+
+    sha1 = hashlib.sha1()
+    for source in sources:
+        sha1.update(FileHash(source).encode())
+
+    meta = {
+        'signature' : signature,
+        'sha1' : sha1.hexdigest(),
+        'symbols' : symbols,
+        'rows' : len(days)
+    }
+    tmp_path = TempPath(paths['meta'])
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, paths['meta'])
+
+    return meta
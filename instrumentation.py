@@ -0,0 +1,182 @@
+# Opt-in instrumentation of strategy callbacks and library hot paths. Nothing is wrapped until Profiler.Enable,
+# so disabled instrumentation costs nothing. Enabled wrappers record call count, latency histogram and net allocated
+# memory blocks per callback and self time per callback stack for flame graphs.
+#
+# python instrumentation.py <module> <algorithm class> [data directory] runs algorithm on local_engine with
+# instrumentation and writes <algorithm class>.profile.json report and <algorithm class>.folded trace.
+
+import sys
+import json
+import time
+
+# Algorithm callbacks wrapped when present on algorithm class.
+CALLBACKS = ['Initialize', 'Selection', 'CoarseSelectionFunction', 'FineSelectionFunction', 'OnData', 'OnSecuritiesChanged', 'Rebalance']
+
+# NOTE: Statistics of one callback. Latencies are counted in log2 nanosecond buckets, bucket i holds calls
+# with latency in [2^(i-1), 2^i) ns.
+class CallbackStats():
+    __slots__ = ('calls', 'total', 'max', 'allocations', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0          # ns
+        self.max = 0            # ns
+        self.allocations = 0    # net allocated blocks
+        self.buckets = [0] * 64
+
+    def Add(self, elapsed, allocations):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.allocations += allocations
+        self.buckets[min(elapsed.bit_length(), 63)] += 1
+
+    # Upper bound of bucket with q-th quantile in ns.
+    def Quantile(self, q):
+        if self.calls == 0: return 0
+        rank = q * self.calls
+        count = 0
+        for index, bucket in enumerate(self.buckets):
+            count += bucket
+            if count >= rank:
+                return min(1 << index, self.max)
+        return self.max
+
+    def Summary(self):
+        return {
+            'calls' : self.calls,
+            'total' : self.total / 1e9,
+            'mean' : self.total / self.calls / 1e9 if self.calls != 0 else 0.,
+            'p50' : self.Quantile(0.5) / 1e9,
+            'p95' : self.Quantile(0.95) / 1e9,
+            'max' : self.max / 1e9,
+            'allocations' : self.allocations,
+            'histogram' : { str(1 << index) : bucket for index, bucket in enumerate(self.buckets) if bucket != 0 }
+        }
+
+class Profiler():
+    def __init__(self):
+        self.stats = {}     # label -> CallbackStats
+        self.folded = {}    # callback stack -> self time ns
+        self.stack = []     # [label, child time ns] of active callbacks
+        self.path = ()
+        self.targets = []   # (owner, name, label)
+        self.patched = []   # (owner, name, original)
+        self.start = None
+        self.wall = 0
+
+    # Registers function attribute of class or module for wrapping.
+    def Instrument(self, owner, name, label = None):
+        if label is None:
+            label = getattr(owner, '__name__', str(owner)) + '.' + name
+        self.targets.append((owner, name, label))
+
+    def InstrumentAlgorithm(self, algorithm_type, callbacks = CALLBACKS):
+        for name in callbacks:
+            for owner in algorithm_type.__mro__:
+                if name in owner.__dict__:
+                    self.Instrument(owner, name, algorithm_type.__name__ + '.' + name)
+                    break
+
+        # Custom data of algorithm module, parse time of its rows.
+        module = sys.modules.get(algorithm_type.__module__)
+        if hasattr(module, 'ESGData'):
+            self.Instrument(module.ESGData, 'Reader', 'ESGData.Reader')
+
+    # Shared hot paths of k_data: futures parsing, tranche rebalancing, trade expiry and SLSQP solve of PortfolioOptimization.
+    def InstrumentLibrary(self):
+        import k_data
+        self.Instrument(k_data.QuantpediaFutures, 'Reader')
+        self.Instrument(k_data.TargetRebalancer, 'Rebalance')
+        self.Instrument(k_data.TradeManager, 'TryLiquidate')
+        self.Instrument(k_data, 'minimize', 'PortfolioOptimization.SLSQP')
+
+    def Enable(self):
+        for owner, name, label in self.targets:
+            original = owner.__dict__[name]
+            setattr(owner, name, self.Wrap(original, label))
+            self.patched.append((owner, name, original))
+        self.start = time.perf_counter_ns()
+
+    def Disable(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+        if self.start is not None:
+            self.wall += time.perf_counter_ns() - self.start
+            self.start = None
+
+    def __enter__(self):
+        self.Enable()
+        return self
+
+    def __exit__(self, *args):
+        self.Disable()
+
+    def Wrap(self, original, label):
+        stats = self.stats.setdefault(label, CallbackStats())
+        profiler = self
+        clock = time.perf_counter_ns
+        blocks = sys.getallocatedblocks
+
+        def wrapper(*args, **kwargs):
+            profiler.Enter(label)
+            allocated = blocks()
+            start = clock()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                stats.Add(elapsed, blocks() - allocated)
+                profiler.Exit(elapsed)
+
+        wrapper.__name__ = getattr(original, '__name__', label)
+        wrapper.__wrapped__ = original
+        return wrapper
+
+    def Enter(self, label):
+        self.stack.append([label, 0])
+        self.path = self.path + (label,)
+
+    def Exit(self, elapsed):
+        label, child = self.stack.pop()
+        self.folded[self.path] = self.folded.get(self.path, 0) + elapsed - child
+        self.path = self.path[:-1]
+        if len(self.stack) != 0:
+            self.stack[-1][1] += elapsed
+
+    def Report(self):
+        return {
+            'wall' : (self.wall + (time.perf_counter_ns() - self.start if self.start is not None else 0)) / 1e9,
+            'callbacks' : { label : stats.Summary() for label, stats in self.stats.items() }
+        }
+
+    def WriteReport(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.Report(), f, indent = 1)
+
+    # Collapsed stacks, one "outer;inner self_time_us" line per callback stack. Input of flamegraph.pl and speedscope.
+    def WriteTrace(self, path):
+        with open(path, 'w') as f:
+            for stack, elapsed in sorted(self.folded.items()):
+                f.write('%s %d\n' % (';'.join(stack), elapsed // 1000))
+
+if __name__ == '__main__':
+    import local_engine
+    import importlib
+
+    local_engine.Install()
+    module, algorithm = sys.argv[1], sys.argv[2]
+    data_dir = sys.argv[3] if len(sys.argv) > 3 else '.'
+
+    profiler = Profiler()
+    profiler.InstrumentAlgorithm(getattr(importlib.import_module(module), algorithm))
+    profiler.InstrumentLibrary()
+    with profiler:
+        result = local_engine.Backtest(module, algorithm, data_dir)
+
+    profiler.WriteReport(algorithm + '.profile.json')
+    profiler.WriteTrace(algorithm + '.folded')
+    for label, summary in profiler.Report()['callbacks'].items():
+        print('%-50s calls=%-6d total=%.4fs p95=%.6fs allocations=%d' % (label, summary['calls'], summary['total'], summary['p95'], summary['allocations']))
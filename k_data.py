@@ -1,8 +1,55 @@
+import sys
+from datetime import timedelta
+import heapq
+import multiprocessing
 import numpy as np
 from scipy.optimize import minimize
+import futures_store
+import esg_store
 
 sp100_stocks = ['AAPL','MSFT','AMZN','FB','BRKB','GOOGL','GOOG','JPM','JNJ','V','PG','XOM','UNH','BAC','MA','T','DIS','INTC','HD','VZ','MRK','PFE','CVX','KO','CMCSA','CSCO','PEP','WFC','C','BA','ADBE','WMT','CRM','MCD','MDT','BMY','ABT','NVDA','NFLX','AMGN','PM','PYPL','TMO','COST','ABBV','ACN','HON','NKE','UNP','UTX','NEE','IBM','TXN','AVGO','LLY','ORCL','LIN','SBUX','AMT','LMT','GE','MMM','DHR','QCOM','CVS','MO','LOW','FIS','AXP','BKNG','UPS','GILD','CHTR','CAT','MDLZ','GS','USB','CI','ANTM','BDX','TJX','ADP','TFC','CME','SPGI','COP','INTU','ISRG','CB','SO','D','FISV','PNC','DUK','SYK','ZTS','MS','RTN','AGN','BLK']
 
+# NOTE: Ticker universe index. Tickers are normalized to upper case once and interned to integer ids (position in
+# universe). Membership and id lookup are single dict lookups.
+class TickerIndex():
+    def __init__(self, tickers = []):
+        self.tickers = []   # id -> ticker
+        self.ids = {}       # ticker -> id
+        for ticker in tickers:
+            self.Add(ticker)
+    
+    # Adds ticker and returns its id. Positions of `tickers` follow the source columns (ESG header), so duplicate
+    # ticker takes a position too while its id stays the first one.
+    def Add(self, ticker):
+        ticker = sys.intern(ticker.upper())
+        self.tickers.append(ticker)
+        return self.ids.setdefault(ticker, len(self.tickers) - 1)
+    
+    # Id of ticker or -1 if it's not in universe.
+    def Id(self, ticker):
+        ticker_id = self.ids.get(ticker, -1)
+        if ticker_id == -1 and not ticker.isupper():
+            ticker_id = self.ids.get(ticker.upper(), -1)
+        return ticker_id
+    
+    def __contains__(self, ticker):
+        return self.Id(ticker) != -1
+    
+    # Number of positions, duplicates included.
+    def __len__(self):
+        return len(self.tickers)
+
+sp100_index = TickerIndex(sp100_stocks)
+
+# Algorithm parameter converted to type of default. Default is used if parameter is not set.
+def Parameter(algorithm, name, default):
+    value = algorithm.GetParameter(name)
+    if value is None or value == '':
+        return default
+    if isinstance(default, bool):
+        return str(value).lower() in ('true', '1')
+    return type(default)(value)
+
 def MonthDiff(d1, d2):
     return (d1.year - d2.year) * 12 + d1.month - d2.month
 
@@ -10,10 +57,257 @@ def Return(values):
     return (values[-1] - values[0]) / values[0]
     
 def Volatility(values):
-    values = np.array(values)
+    values = np.asarray(values)
     returns = (values[1:] - values[:-1]) / values[:-1]
     return np.std(returns)  
 
+# NOTE: Batch indicators. Prices are 2-D (time x assets) matrix, every indicator is computed for all assets at once.
+# Rolling windows are strided views of input, data are not copied.
+
+# Simple returns, (time - 1) x assets.
+def BatchReturns(prices):
+    prices = np.asarray(prices, dtype = np.float64)
+    return prices[1:] / prices[:-1] - 1
+
+# Return over whole period for every asset.
+def BatchReturn(prices):
+    prices = np.asarray(prices, dtype = np.float64)
+    return (prices[-1] - prices[0]) / prices[0]
+
+# Volatility of simple returns for every asset.
+def BatchVolatility(prices):
+    return np.std(BatchReturns(prices), axis = 0)
+
+# Windows view, (time - window + 1) x assets x window.
+def RollingWindows(values, window):
+    return np.lib.stride_tricks.sliding_window_view(np.asarray(values), window, axis = 0)
+
+# Volatility of returns over every rolling window, (time - window) x assets.
+def RollingVolatility(prices, window):
+    return RollingWindows(BatchReturns(prices), window).std(axis = -1)
+
+# Momentum over period ending `skip` rows before the last one for every asset.
+def BatchMomentum(prices, period, skip = 0):
+    prices = np.asarray(prices, dtype = np.float64)
+    end = len(prices) - 1 - skip
+    return prices[end] / prices[end - period] - 1
+
+# Momentum over period at every row, (time - period) x assets.
+def RollingMomentum(prices, period):
+    prices = np.asarray(prices, dtype = np.float64)
+    return prices[period:] / prices[:-period] - 1
+
+# Drawdown from running maximum at every row and maximum drawdown for every asset.
+def BatchDrawdown(prices):
+    prices = np.asarray(prices, dtype = np.float64)
+    drawdown = prices / np.maximum.accumulate(prices, axis = 0) - 1
+    return drawdown, drawdown.min(axis = 0)
+
+# NOTE: Data ingest at declared decision resolution. Engine resolutions (Daily, Hour, Minute) are subscribed directly,
+# so only decision bars are ingested. Custom periods (timedelta) are consolidated from minute feed at ingest.
+# Handler receives one bar per symbol and decision period.
+class DecisionFeed():
+    def __init__(self, algorithm, resolution, handler):
+        self.algorithm = algorithm
+        self.resolution = resolution
+        self.handler = handler
+        
+        # Symbols subscribed at engine resolution. Their bars are dispatched from OnData.
+        self.symbols = []
+    
+    def AddEquity(self, ticker):
+        if isinstance(self.resolution, timedelta):
+            security = self.algorithm.AddEquity(ticker, Resolution.Minute)
+            self.algorithm.Consolidate(security.Symbol, self.resolution, self.handler)
+        else:
+            security = self.algorithm.AddEquity(ticker, self.resolution)
+            self.symbols.append(security.Symbol)
+        return security
+    
+    def OnData(self, data):
+        for symbol in self.symbols:
+            if data.Bars.ContainsKey(symbol):
+                self.handler(data.Bars[symbol])
+
+# NOTE: Lookback cache of daily closes. Every symbol keeps ring buffer of last closes consolidated from live feed,
+# close N trading days ago is read in O(1) without history request.
+class PriceRing():
+    __slots__ = ('values', 'count', 'last_time')
+    
+    def __init__(self, length):
+        self.values = np.zeros(length)
+        self.count = 0          # number of stored closes
+        self.last_time = None   # end time of last stored bar
+
+class PriceCache():
+    def __init__(self, lookback):
+        self.length = lookback + 1  # today plus lookback days
+        self.rings = {}             # symbol -> PriceRing
+    
+    # Stores daily close. Bars not newer than last stored one are ignored, so seeding and live feed can overlap.
+    def Update(self, symbol, time, close):
+        ring = self.rings.get(symbol)
+        if ring is None:
+            ring = self.rings[symbol] = PriceRing(self.length)
+        if ring.last_time is not None and time <= ring.last_time:
+            return
+        
+        ring.values[ring.count % self.length] = close
+        ring.count += 1
+        ring.last_time = time
+    
+    def IsReady(self, symbol, days_ago):
+        ring = self.rings.get(symbol)
+        return ring is not None and days_ago < min(ring.count, self.length)
+    
+    # Close `days_ago` trading days before the last one or None if it's not stored.
+    def Close(self, symbol, days_ago):
+        if not self.IsReady(symbol, days_ago):
+            return None
+        ring = self.rings[symbol]
+        return float(ring.values[(ring.count - 1 - days_ago) % self.length])
+
+# NOTE: Ring buffer of cross-sections. Rows are periods, columns are tickers.
+# Every append is one row write over the oldest period, lags are returned as views of whole universe.
+class CrossSectionHistory():
+    def __init__(self, tickers, period, dtype = np.float32):
+        self.universe = tickers if isinstance(tickers, TickerIndex) else TickerIndex(tickers)
+        self.tickers = self.universe.tickers
+        self.index = self.universe.ids  # ticker -> column
+        self.period = period
+        self.values = np.zeros((period, len(self.tickers)), dtype = dtype)
+        self.count = 0  # number of appended periods
+    
+    def Append(self, row):
+        self.values[self.count % self.period] = row
+        self.count += 1
+    
+    def IsReady(self):
+        return self.count >= self.period
+    
+    # Cross-section appended `lag` periods ago. Lag 0 is the latest one, period - 1 the oldest one.
+    def Lag(self, lag):
+        return self.values[(self.count - 1 - lag) % self.period]
+    
+    # Column of ticker or -1 if it's not stored.
+    def Column(self, ticker):
+        return self.index.get(ticker, -1)
+    
+    # Values of tickers `lag` periods ago and mask of tickers with full history.
+    def Gather(self, tickers, lag):
+        columns = np.fromiter((self.index.get(ticker, -1) for ticker in tickers), dtype = np.int64, count = len(tickers))
+        found = (columns != -1) & self.IsReady()
+        return self.Lag(lag)[np.where(found, columns, 0)], found
+    
+    # Scalar in storage precision. Thresholds compared against stored values should be converted first.
+    def Scalar(self, value):
+        return self.values.dtype.type(value)
+
+# NOTE: Cross-sectional momentum ranking. Momentum of whole universe is computed at once, names without history
+# or with zero value are masked out and tails are picked by partial selection instead of full sort.
+# Ties are resolved as in stable descending sort.
+class MomentumTail():
+    __slots__ = ('symbols', 'scores', 'caps')
+    
+    def __init__(self, symbols, scores, caps):
+        self.symbols = symbols  # list of symbols, highest score first
+        self.scores = scores    # float array
+        self.caps = caps        # float array
+    
+    def __len__(self):
+        return len(self.symbols)
+
+# symbols   - universe symbols
+# columns   - history column of every symbol, -1 if missing
+# recent    - cross-section at the end of momentum period
+# past      - cross-section at the start of momentum period
+# caps      - market cap of every symbol
+def RankMomentum(symbols, columns, recent, past, caps, quantile = 10, ratio = True):
+    columns = np.asarray(columns, dtype = np.int64)
+    caps = np.asarray(caps, dtype = np.float64)
+    
+    valid = columns != -1
+    safe_columns = np.where(valid, columns, 0)
+    recent = recent[safe_columns].astype(np.float64)
+    past = past[safe_columns].astype(np.float64)
+    valid &= (recent != 0) & (past != 0)
+    
+    index = np.flatnonzero(valid)
+    scores = np.full(len(columns), np.nan)
+    if ratio:
+        # Momentum as ratio.
+        scores[index] = recent[index] / past[index] - 1
+    else:
+        # Momentum as difference.
+        scores[index] = recent[index] - past[index]
+    
+    return RankScores(symbols, scores, caps, quantile)
+
+# Tails of precomputed momentum scores, NaN marks names without momentum.
+def RankScores(symbols, scores, caps, quantile = 10):
+    scores = np.asarray(scores, dtype = np.float64)
+    caps = np.asarray(caps, dtype = np.float64)
+    
+    index = np.flatnonzero(~np.isnan(scores))
+    scores = scores[index]
+    
+    count = int(len(index) / quantile)
+    long = TailIndex(scores, count, True)
+    short = TailIndex(scores, count, False)
+    
+    long = MomentumTail([symbols[i] for i in index[long]], scores[long], caps[index[long]])
+    short = MomentumTail([symbols[i] for i in index[short]], scores[short], caps[index[short]])
+    
+    # Tails and number of ranked names.
+    return long, short, len(index)
+
+# Positions of `count` highest (largest = True) or lowest scores ordered by descending score.
+def TailIndex(scores, count, largest):
+    if count == 0:
+        return np.empty(0, dtype = np.int64)
+    
+    n = len(scores)
+    if largest:
+        kth = np.partition(scores, n - count)[n - count]
+        better = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[:count - len(better)]
+    else:
+        kth = np.partition(scores, count - 1)[count - 1]
+        better = np.flatnonzero(scores < kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[len(ties) - (count - len(better)):]
+    
+    selected = np.sort(np.concatenate((better, ties)))
+    return selected[np.argsort(-scores[selected], kind = 'stable')]
+
+# NOTE: Single pass screen of long/short legs. All predicates are evaluated as masks over the whole universe.
+# Thresholds are compared in precision of deciles. Returns positions of long and short names.
+# deciles   - decile of every name
+# ready     - name has full decile history
+# invested  - name is already held, None if not screened
+def ScreenLegs(deciles, ready, invested = None, long_threshold = 0.8, short_threshold = 0.2):
+    eligible = ready & (deciles != 0)
+    if invested is not None:
+        eligible &= ~invested
+    
+    long = np.flatnonzero(eligible & (deciles >= deciles.dtype.type(long_threshold)))
+    short = np.flatnonzero(eligible & (deciles <= deciles.dtype.type(short_threshold)))
+    return long, short
+
+# Legs of precomputed decile screen (esg_store.ESGSignals.Flags). Returns positions of long and short names.
+# flags     - flag bits of every name
+# ready     - name has full decile history
+# invested  - name is already held, None if not screened
+def FlagLegs(flags, ready, invested = None):
+    eligible = ready
+    if invested is not None:
+        eligible = eligible & ~invested
+    
+    long = np.flatnonzero(eligible & ((flags & esg_store.LONG_FLAG) != 0))
+    short = np.flatnonzero(eligible & ((flags & esg_store.SHORT_FLAG) != 0))
+    return long, short
+
 # Custom fee model
 class CustomFeeModel(FeeModel):
     def GetOrderFee(self, parameters):
@@ -33,7 +327,14 @@ class QuandlFINRA_ShortVolume(PythonQuandl):
 # Quantpedia data
 # NOTE: IMPORTANT: Data order must be ascending (datewise)
 class QuantpediaFutures(PythonData):
+    # Optional futures_store.FuturesStore. Settle prices of stored symbols are served from it instead of parsing text.
+    # Set once in Initialize before subscribing, e.g. QuantpediaFutures.store = futures_store.FuturesStore.TryLoad(symbols)
+    store = None
+    
     def GetSource(self, config, date, isLiveMode):
+        store = QuantpediaFutures.store
+        if store is not None and config.Symbol.Value in store.column:
+            return SubscriptionDataSource(futures_store.SourcePath(store.source_dir, config.Symbol.Value), SubscriptionTransportMedium.LocalFile, FileFormat.Csv)
         return SubscriptionDataSource("data.quantpedia.com/backtesting_data/futures/{0}.csv".format(config.Symbol.Value), SubscriptionTransportMedium.RemoteFile, FileFormat.Csv)
 
     def Reader(self, config, line, date, isLiveMode):
@@ -41,16 +342,170 @@ class QuantpediaFutures(PythonData):
         data.Symbol = config.Symbol
         
         if not line[0].isdigit(): return None
+        
+        store = QuantpediaFutures.store
+        if store is not None and config.Symbol.Value in store.column:
+            index = store.RowIndex(line)
+            if index is not None:
+                settle = store.Settle(config.Symbol.Value, index)
+                data.Time = store.times[index]
+                data['settle'] = settle
+                data.Value = settle
+                return data
+        
         split = line.split(';')
         
-        data.Time = datetime.strptime(split[0], "%d.%m.%Y") + timedelta(days=1)
+        data.Time = futures_store.ParseDate(split[0]) + timedelta(days=1)
         data['settle'] = float(split[1])
         data.Value = float(split[1])
 
         return data
         
+# NOTE: Delta based universe. Selection is compared with the previous one. Unchanged selection is returned as
+# Universe.Unchanged, so engine skips resubscription. Changed selection is returned whole, engine diffs it against
+# current members itself and passes only additions and removals to OnSecuritiesChanged.
+class UniverseTracker():
+    def __init__(self):
+        self.selected = set()
+    
+    # Symbols to return from selection function.
+    def Select(self, symbols):
+        current = set(symbols)
+        if current == self.selected:
+            return Universe.Unchanged
+        self.selected = current
+        return symbols
+
+# Target weights of one tranche legs. Caps are market caps of long and short names.
+def TrancheWeights(long_caps, short_caps, holding_period, value_weighting):
+    long_caps = np.asarray(long_caps, dtype = np.float64)
+    short_caps = np.asarray(short_caps, dtype = np.float64)
+    
+    if value_weighting:
+        weight = 1 / (holding_period * 2)
+        long_weights = weight * long_caps / long_caps.sum() if len(long_caps) != 0 else long_caps
+        short_weights = weight * short_caps / short_caps.sum() if len(short_caps) != 0 else short_caps
+        return long_weights, short_weights
+    
+    # Equally weighted.
+    count = len(long_caps) + len(short_caps)
+    weight = 1 / (holding_period * count) if count != 0 else 0
+    return np.full(len(long_caps), weight), np.full(len(short_caps), weight)
+
+# NOTE: Staggered tranches stored as struct of arrays. Every tranche keeps symbol ids, weights and sides.
+# Tranches live in ring of slots, rolling off the oldest one only moves the head pointer.
+class Tranche():
+    __slots__ = ('ids', 'weights', 'sides', 'count')
+    
+    def __init__(self, ids, weights, sides):
+        self.ids = ids          # int array of symbol ids in book
+        self.weights = weights  # float array of absolute target weights
+        self.sides = sides      # int8 array, 1 - long, -1 - short
+        self.count = len(ids)
+
+class TrancheBook():
+    def __init__(self, size):
+        self.size = size            # maximum count of live tranches
+        self.slots = [None] * size
+        self.head = 0               # slot of the oldest tranche
+        self.length = 0
+        
+        # Symbol <-> id.
+        self.symbols = []
+        self.ids = {}
+    
+    def __len__(self):
+        return self.length
+    
+    def IsFull(self):
+        return self.length == self.size
+    
+    def Id(self, symbol):
+        if symbol not in self.ids:
+            self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self.ids[symbol]
+    
+    # Stores new tranche. Oldest one is dropped if book is full.
+    def Append(self, long_symbols, long_weights, short_symbols, short_weights):
+        if self.IsFull():
+            self.PopOldest()
+        
+        ids = np.array([self.Id(symbol) for symbol in list(long_symbols) + list(short_symbols)], dtype = np.int64)
+        weights = np.concatenate((np.asarray(long_weights, dtype = np.float64), np.asarray(short_weights, dtype = np.float64)))
+        sides = np.concatenate((np.ones(len(long_symbols), dtype = np.int8), -np.ones(len(short_symbols), dtype = np.int8)))
+        
+        self.slots[(self.head + self.length) % self.size] = Tranche(ids, weights, sides)
+        self.length += 1
+    
+    def PopOldest(self):
+        tranche = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % self.size
+        self.length -= 1
+        return tranche
+    
+    def Newest(self):
+        return self.slots[(self.head + self.length - 1) % self.size]
+    
+    # Net target weight per symbol across all live tranches.
+    def NetExposure(self):
+        live = [self.slots[(self.head + i) % self.size] for i in range(self.length)]
+        if len(live) == 0:
+            return {}
+        
+        ids = np.concatenate([x.ids for x in live])
+        weights = np.concatenate([x.weights * x.sides for x in live])
+        net = np.bincount(ids, weights = weights, minlength = len(self.symbols)).tolist()
+        
+        held = np.flatnonzero(np.bincount(ids, minlength = len(self.symbols)))
+        return { self.symbols[i] : net[i] for i in held.tolist() }
+
+# NOTE: Rebalancer to netted target weights. Targets are compared with targets of previous rebalance, only symbols
+# whose target changed (members of newest or expired tranche) are traded. Positions of unchanged targets are left
+# to drift. Changed targets of held positions within tolerance weight of current holding are skipped, new positions
+# and liquidations are always traded. Orders reducing exposure go first to free buying power.
+class TargetRebalancer():
+    def __init__(self, algorithm, tolerance = 0.001):
+        self.algorithm = algorithm  # algorithm to execute orders in.
+        self.tolerance = tolerance  # absolute portfolio weight
+        
+        # Non zero targets of previous rebalance.
+        self.targets = {}
+    
+    def Rebalance(self, targets):
+        portfolio = self.algorithm.Portfolio
+        total_value = float(portfolio.TotalPortfolioValue)
+        if total_value <= 0: return
+        
+        decrease = []
+        increase = []
+        for symbol in set(self.targets) | set(targets):
+            target = targets.get(symbol, 0)
+            current = float(portfolio[symbol].HoldingsValue) / total_value if portfolio.ContainsKey(symbol) else 0
+            
+            if target == 0:
+                if current != 0: decrease.append((symbol, target))
+                continue
+            # Positions not opened yet are always traded.
+            if current != 0 and (target == self.targets.get(symbol, 0) or abs(target - current) <= self.tolerance):
+                continue
+            
+            if abs(target) < abs(current) or target * current < 0: decrease.append((symbol, target))
+            else: increase.append((symbol, target))
+        
+        for symbol, target in decrease + increase:
+            if target == 0:
+                self.algorithm.Liquidate(symbol)
+            else:
+                self.algorithm.SetHoldings(symbol, target)
+        
+        self.targets = { symbol : target for symbol, target in targets.items() if target != 0 }
+
 # NOTE: Manager for new trades. It's represented by certain count of equally weighted brackets for long and short positions.
 # If there's a place for new trade, it will be managed for time of holding period.
+# Trades are kept in min-heap by absolute expiry day and indexed by ticker, so daily tick costs O(expiring) and
+# ticker liquidation is a dict lookup. Trades liquidated by ticker are dropped from heap lazily.
 class TradeManager():
     def __init__(self, algorithm, long_size, short_size, holding_period):
         self.algorithm = algorithm  # algorithm to execute orders in.
@@ -62,9 +517,12 @@ class TradeManager():
         self.long_len = 0
         self.short_len = 0
     
-        # Arrays of ManagedSymbols
-        self.symbols = []
+        # Heap of (expiry day, sequence, ManagedSymbol) and ticker -> ManagedSymbols.
+        self.expiries = []
+        self.positions = {}
+        self.sequence = 0
         
+        self.day = 0                            # Count of TryLiquidate calls.
         self.holding_period = holding_period    # Days of holding.
     
     # Add stock symbol object
@@ -75,83 +533,162 @@ class TradeManager():
         if long_flag:
             # If there's a place for it.
             if self.long_len < self.long_size:
-                self.symbols.append(managed_symbol)
+                self.Manage(managed_symbol)
                 self.algorithm.SetHoldings(symbol, self.weight)
                 self.long_len += 1
         # Open new short trade.
         else:
             # If there's a place for it.
-            if self.long_len < self.short_size:
-                self.symbols.append(managed_symbol)
+            if self.short_len < self.short_size:
+                self.Manage(managed_symbol)
                 self.algorithm.SetHoldings(symbol, - self.weight)
                 self.short_len += 1
     
-    # Decrement holding period and liquidate symbols.
+    def Manage(self, managed_symbol):
+        managed_symbol.expiry = self.day + managed_symbol.days_to_liquidate
+        heapq.heappush(self.expiries, (managed_symbol.expiry, self.sequence, managed_symbol))
+        self.sequence += 1
+        
+        self.positions.setdefault(managed_symbol.symbol.Value, []).append(managed_symbol)
+    
+    def Release(self, managed_symbol):
+        managed_symbol.active = False
+        self.algorithm.Liquidate(managed_symbol.symbol)
+        
+        if managed_symbol.long_flag: self.long_len -= 1
+        else: self.short_len -= 1
+        
+        ticker = managed_symbol.symbol.Value
+        self.positions[ticker].remove(managed_symbol)
+        if len(self.positions[ticker]) == 0:
+            del self.positions[ticker]
+    
+    # Advance one day and liquidate expired symbols.
     def TryLiquidate(self):
-        symbols_to_delete = []
-        for managed_symbol in self.symbols:
-            managed_symbol.days_to_liquidate -= 1
+        self.day += 1
+        
+        while len(self.expiries) != 0 and self.expiries[0][0] <= self.day:
+            expiry, sequence, managed_symbol = heapq.heappop(self.expiries)
+            
+            # Already liquidated by ticker.
+            if not managed_symbol.active: continue
             
-            # Liquidate.
-            if managed_symbol.days_to_liquidate == 0:
-                symbols_to_delete.append(managed_symbol)
-                self.algorithm.Liquidate(managed_symbol.symbol)
-                
-                if managed_symbol.long_flag: self.long_len -= 1
-                else: self.short_len -= 1
-
-        # Remove symbols from management.
-        for managed_symbol in symbols_to_delete:
-            self.symbols.remove(managed_symbol)
+            self.Release(managed_symbol)
     
     def LiquidateTicker(self, ticker):
-        symbol_to_delete = None
-        for managed_symbol in self.symbols:
-            if managed_symbol.symbol.Value == ticker:
-                self.algorithm.Liquidate(managed_symbol.symbol)
-                symbol_to_delete = managed_symbol
-                if managed_symbol.long_flag: self.long_len -= 1
-                else: self.short_len -= 1
-                
-                break
-        
-        if symbol_to_delete: self.symbols.remove(symbol_to_delete)
+        if ticker in self.positions:
+            self.Release(self.positions[ticker][0])
         else: self.algorithm.Debug("Ticker is not held in portfolio!")
     
+    # Days left until liquidation of managed symbol.
+    def DaysToLiquidate(self, managed_symbol):
+        return managed_symbol.expiry - self.day
+    
 class ManagedSymbol():
+    __slots__ = ('symbol', 'days_to_liquidate', 'long_flag', 'expiry', 'active')
+    
     def __init__(self, symbol, days_to_liquidate, long_flag):
         self.symbol = symbol
-        self.days_to_liquidate = days_to_liquidate
+        self.days_to_liquidate = days_to_liquidate  # Holding period when added.
         self.long_flag = long_flag
+        self.expiry = 0                             # Absolute day of liquidation.
+        self.active = True
         
 class PortfolioOptimization(object):
-    def __init__(self, df_return, risk_free_rate, num_assets):
+    # method: 'max_sharpe'  - maximize sharpe ratio
+    #         'target_vol'  - maximize return with volatility not above target_vol
+    #         'min_variance' - minimize portfolio variance
+    # num_factors: None - sample covariance, otherwise statistical factor risk model with that many factors
+    def __init__(self, df_return, risk_free_rate, num_assets, method = 'max_sharpe', target_vol = 0.05, num_factors = None):
         self.daily_return = df_return
         self.risk_free_rate = risk_free_rate
         self.n = num_assets # numbers of risk assets in portfolio
-        self.target_vol = 0.05
+        self.method = method
+        self.target_vol = target_vol
+        
+        # annual moments are computed once per solve
+        self.annual_mean = np.asarray(self.daily_return.mean(), dtype = np.float64) * 252
+        if num_factors is None:
+            self.annual_cov = np.asarray(self.daily_return.cov(), dtype = np.float64) * 252
+        else:
+            self.annual_cov = FactorRiskModel.from_returns(self.daily_return, num_factors).scaled(252)
+
+    @classmethod
+    def from_moments(cls, annual_mean, annual_cov, risk_free_rate, method = 'max_sharpe', target_vol = 0.05):
+        # optimizer over precomputed annual moments, annual_cov is covariance matrix or FactorRiskModel
+        opt = cls.__new__(cls)
+        opt.daily_return = None
+        opt.risk_free_rate = risk_free_rate
+        opt.n = len(annual_mean)
+        opt.method = method
+        opt.target_vol = target_vol
+        opt.annual_mean = annual_mean
+        opt.annual_cov = annual_cov
+        return opt
 
     def annual_port_return(self, weights):
         # calculate the annual return of portfolio
-        return np.sum(self.daily_return.mean() * weights) * 252
+        return np.dot(self.annual_mean, weights)
 
     def annual_port_vol(self, weights):
         # calculate the annual volatility of portfolio
-        return np.sqrt(np.dot(weights.T, np.dot(self.daily_return.cov() * 252, weights)))
+        return np.sqrt(np.dot(weights.T, self.annual_cov.dot(weights)))
 
     def min_func(self, weights):
-        # method 1: maximize sharp ratio
-        return - self.annual_port_return(weights) / self.annual_port_vol(weights)
+        return self.min_func_grad(weights)[0]
+
+    def min_func_grad(self, weights):
+        # objective of selected method and its exact gradient
+        cov_weights = self.annual_cov.dot(weights)
+        port_return = np.dot(self.annual_mean, weights)
         
-        # method 2: maximize the return with target volatility
-        #return - self.annual_port_return(weights) / self.target_vol
+        if self.method == 'max_sharpe':
+            # method 1: maximize sharp ratio
+            port_vol = np.sqrt(np.dot(weights, cov_weights))
+            value = - port_return / port_vol
+            grad = - self.annual_mean / port_vol + port_return * cov_weights / port_vol ** 3
+        elif self.method == 'target_vol':
+            # method 2: maximize the return with target volatility
+            value = - port_return / self.target_vol
+            grad = - self.annual_mean / self.target_vol
+        elif self.method == 'min_variance':
+            # method 3: minimize variance
+            value = np.dot(weights, cov_weights)
+            grad = 2 * cov_weights
+        else:
+            raise ValueError("Unknown optimization method: {0}".format(self.method))
+        
+        return value, grad
+
+    def vol_constraint(self, weights):
+        # target volatility minus portfolio volatility, non-negative if satisfied
+        return self.target_vol - self.annual_port_vol(weights)
+
+    def vol_constraint_grad(self, weights):
+        cov_weights = self.annual_cov.dot(weights)
+        return - cov_weights / np.sqrt(np.dot(weights, cov_weights))
 
-    def opt_portfolio(self):
-        # maximize the sharpe ratio to find the optimal weights
-        cons = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
+    def opt_portfolio(self, initial_weights = None, solver = 'SLSQP'):
+        # optimize weights with selected method
+        # initial_weights - optional warm start, e.g. weights of previous rebalance
+        # solver          - 'SLSQP' or 'projected_gradient' for large universes (max_sharpe and min_variance only)
+        cons = [{'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: np.ones_like(x)}]
+        if self.method == 'target_vol':
+            cons.append({'type': 'ineq', 'fun': self.vol_constraint, 'jac': self.vol_constraint_grad})
         bnds = tuple((0, 1) for x in range(2)) + tuple((0, 0.25) for x in range(self.n - 2))
-        opt = minimize(self.min_func,                               # object function
-                       np.array(self.n * [1. / self.n]),            # initial value
+        
+        if initial_weights is None or len(initial_weights) != self.n:
+            initial_weights = np.array(self.n * [1. / self.n])
+        else:
+            # keep warm start inside bounds
+            initial_weights = np.clip(np.asarray(initial_weights, dtype = np.float64), [x[0] for x in bnds], [x[1] for x in bnds])
+        
+        if solver == 'projected_gradient':
+            return self.projected_gradient(initial_weights, np.array([x[0] for x in bnds], dtype = np.float64), np.array([x[1] for x in bnds], dtype = np.float64))
+        
+        opt = minimize(self.min_func_grad,                          # object function and its gradient
+                       initial_weights,                             # initial value
+                       jac=True,
                        method='SLSQP',                              # optimization method
                        bounds=bnds,                                 # bounds for variables 
                        constraints=cons)                            # constraint conditions
@@ -160,8 +697,260 @@ class PortfolioOptimization(object):
  
         return opt_weights
 
+    def projected_gradient(self, weights, lower, upper, max_iter = 1000, tol = 1e-9):
+        # projected gradient descent over fully invested box constrained weights, O(n) memory and O(n k) per step
+        # with factor risk model. Step starts at Barzilai-Borwein estimate and is backtracked until objective decreases.
+        if self.method == 'target_vol':
+            raise ValueError("Projected gradient solver does not support target_vol method")
+        
+        weights = ProjectCappedSimplex(weights, lower, upper)
+        value, grad = self.min_func_grad(weights)
+        step = 1.
+        for i in range(max_iter):
+            while True:
+                candidate = ProjectCappedSimplex(weights - step * grad, lower, upper)
+                candidate_value, candidate_grad = self.min_func_grad(candidate)
+                if candidate_value <= value - 1e-4 * np.dot(grad, weights - candidate) or step < 1e-12:
+                    break
+                step /= 2
+            
+            move = candidate - weights
+            grad_move = candidate_grad - grad
+            weights, value, grad = candidate, candidate_value, candidate_grad
+            if np.max(np.abs(move)) < tol:
+                break
+            
+            curvature = np.dot(move, grad_move)
+            step = np.dot(move, move) / curvature if curvature > 0 else step * 2
+        
+        return weights
+
+def ProjectCappedSimplex(values, lower, upper, iterations = 100):
+    # euclidean projection onto {sum(w) = 1, lower <= w <= upper} by bisection on shift
+    low = np.min(values - upper)
+    high = np.max(values - lower)
+    for i in range(iterations):
+        shift = (low + high) / 2
+        if np.clip(values - shift, lower, upper).sum() > 1:
+            low = shift
+        else:
+            high = shift
+    return np.clip(values - (low + high) / 2, lower, upper)
+
+# NOTE: Factor risk model. Covariance is B F B' + diag(D) with n x k loadings B, k x k factor covariance F and
+# specific variances D. Products with covariance cost O(n k), n x n matrix is never built.
+class FactorRiskModel(object):
+    def __init__(self, loadings, factor_cov, specific_var):
+        self.loadings = np.asarray(loadings, dtype = np.float64)
+        self.factor_cov = np.asarray(factor_cov, dtype = np.float64)
+        self.specific_var = np.asarray(specific_var, dtype = np.float64)
+
+    @classmethod
+    def from_returns(cls, df_return, num_factors):
+        # statistical model, factors are leading principal components of demeaned returns
+        returns = np.asarray(df_return, dtype = np.float64)
+        returns = returns - returns.mean(axis = 0)
+        
+        u, singular, vt = np.linalg.svd(returns, full_matrices = False)
+        loadings = vt[:num_factors].T
+        factor_returns = np.dot(returns, loadings)
+        residuals = returns - np.dot(factor_returns, loadings.T)
+        
+        count = len(returns) - 1
+        factor_cov = np.dot(factor_returns.T, factor_returns) / count
+        specific_var = np.einsum('ij,ij->j', residuals, residuals) / count
+        return cls(loadings, factor_cov, specific_var)
+
+    def scaled(self, factor):
+        # model with covariance multiplied by factor, e.g. 252 for annualization
+        return FactorRiskModel(self.loadings, self.factor_cov * factor, self.specific_var * factor)
+
+    def dot(self, weights):
+        # covariance times weights
+        exposures = np.dot(self.loadings.T, weights)
+        return np.dot(self.loadings, np.dot(self.factor_cov, exposures)) + self.specific_var * weights
+
+    def variance(self, weights):
+        return np.dot(weights, self.dot(weights))
+
+# NOTE: Batch optimization across process pool. Annual moments are computed once in parent process and handed to
+# every worker once at start, tasks only carry index of moments and method parameters.
+optimization_moments = None
+
+def InitOptimizationWorker(moments):
+    global optimization_moments
+    optimization_moments = moments
+
+def SolveOptimization(task):
+    index, risk_free_rate, method, target_vol, initial_weights = task
+    annual_mean, annual_cov = optimization_moments[index]
+    return PortfolioOptimization.from_moments(annual_mean, annual_cov, risk_free_rate, method, target_vol).opt_portfolio(initial_weights)
+
+# moments   - list of (annual mean, annual covariance) pairs
+# tasks     - list of (moments index, risk free rate, method, target vol, initial weights)
+# processes - pool size, 1 solves serially in current process
+def OptimizeBatch(moments, tasks, processes = None):
+    if processes == 1:
+        InitOptimizationWorker(moments)
+        return [SolveOptimization(task) for task in tasks]
+    
+    with multiprocessing.Pool(processes, initializer = InitOptimizationWorker, initargs = (moments,)) as pool:
+        return pool.map(SolveOptimization, tasks)
+
+def AnnualMoments(df_return):
+    return np.asarray(df_return.mean(), dtype = np.float64) * 252, np.asarray(df_return.cov(), dtype = np.float64) * 252
+
+# Target volatility portfolios for every target in target_vols. Rows of result are weights.
+def EfficientFrontier(df_return, risk_free_rate, target_vols, processes = None):
+    moments = [AnnualMoments(df_return)]
+    tasks = [(0, risk_free_rate, 'target_vol', target_vol, None) for target_vol in target_vols]
+    return np.array(OptimizeBatch(moments, tasks, processes))
+
+# Weights for every rebalance date given its return window. Serial run warm starts from previous weights.
+def WeightPath(df_returns, risk_free_rate, method = 'max_sharpe', target_vol = 0.05, processes = None):
+    moments = [AnnualMoments(df_return) for df_return in df_returns]
+    if processes != 1:
+        tasks = [(i, risk_free_rate, method, target_vol, None) for i in range(len(moments))]
+        return np.array(OptimizeBatch(moments, tasks, processes))
+    
+    path = []
+    weights = None
+    for annual_mean, annual_cov in moments:
+        weights = PortfolioOptimization.from_moments(annual_mean, annual_cov, risk_free_rate, method, target_vol).opt_portfolio(weights)
+        path.append(weights)
+    return np.array(path)
+
+# NOTE: Rolling mean and covariance of daily returns over fixed window. New return row updates moments in O(n^2)
+# with Welford add/remove steps instead of recomputing from whole window. Moments are recomputed exactly from
+# stored rows once per window to bound rounding drift.
+# shrinkage: None          - sample covariance
+#            'ledoit_wolf' - shrink towards scaled identity with Ledoit-Wolf intensity
+#            float         - fixed shrinkage intensity
+class RollingMoments():
+    def __init__(self, num_assets, window, shrinkage = None):
+        self.n = num_assets
+        self.window = window
+        self.shrinkage = shrinkage
+        
+        self.rows = np.zeros((window, num_assets))  # ring buffer of return rows
+        self.count = 0                              # rows in window
+        self.position = 0                           # slot of next row
+        self.updates = 0                            # updates since exact recompute
+        
+        self.mean = np.zeros(num_assets)
+        self.m2 = np.zeros((num_assets, num_assets))    # sum of deviation outer products
+        
+        # Sums of squared row norms, their squares and norm weighted rows for Ledoit-Wolf intensity.
+        self.norm_sum = 0.
+        self.norm_sq_sum = 0.
+        self.norm_row_sum = np.zeros(num_assets)
+    
+    def IsReady(self):
+        return self.count == self.window
+    
+    def Add(self, row):
+        row = np.asarray(row, dtype = np.float64)
+        
+        if self.count == self.window:
+            self.Remove(self.rows[self.position])
+        
+        self.rows[self.position] = row
+        self.position = (self.position + 1) % self.window
+        
+        self.count += 1
+        delta = row - self.mean
+        self.mean += delta / self.count
+        self.m2 += np.outer(delta, row - self.mean)
+        self.AddNorms(row, 1)
+        
+        self.updates += 1
+        if self.updates >= self.window:
+            self.Recompute()
+    
+    def Remove(self, row):
+        row = row.copy()
+        self.count -= 1
+        if self.count == 0:
+            self.mean[:] = 0
+            self.m2[:] = 0
+        else:
+            delta = row - self.mean
+            self.mean -= delta / self.count
+            self.m2 -= np.outer(delta, row - self.mean)
+        self.AddNorms(row, -1)
+    
+    def AddNorms(self, row, sign):
+        norm = np.dot(row, row)
+        self.norm_sum += sign * norm
+        self.norm_sq_sum += sign * norm * norm
+        self.norm_row_sum += sign * norm * row
+    
+    # Exact moments from stored rows.
+    def Recompute(self):
+        self.updates = 0
+        rows = self.Rows()
+        self.mean = rows.mean(axis = 0) if self.count != 0 else np.zeros(self.n)
+        deviations = rows - self.mean
+        self.m2 = np.dot(deviations.T, deviations)
+        
+        norms = np.einsum('ij,ij->i', rows, rows)
+        self.norm_sum = norms.sum()
+        self.norm_sq_sum = np.dot(norms, norms)
+        self.norm_row_sum = np.dot(norms, rows)
+    
+    # Rows in window, oldest first.
+    def Rows(self):
+        if self.count < self.window:
+            return self.rows[:self.count]
+        return np.roll(self.rows, -self.position, axis = 0)
+    
+    def Mean(self):
+        return self.mean.copy()
+    
+    def Covariance(self):
+        cov = self.m2 / (self.count - 1)
+        intensity = self.ShrinkageIntensity()
+        if intensity == 0:
+            return cov
+        
+        target = np.trace(cov) / self.n
+        shrunk = (1 - intensity) * cov
+        shrunk[np.diag_indices(self.n)] += intensity * target
+        return shrunk
+    
+    def ShrinkageIntensity(self):
+        if self.shrinkage is None:
+            return 0.
+        if self.shrinkage != 'ledoit_wolf':
+            return float(self.shrinkage)
+        
+        # Ledoit-Wolf on biased sample covariance.
+        count = self.count
+        sample = self.m2 / count
+        target = np.trace(sample) / self.n
+        
+        dispersion = np.sum(sample * sample) - 2 * target * np.trace(sample) + self.n * target * target
+        if dispersion <= 0:
+            return 0.
+        
+        # Sum of fourth powers of deviation norms from running sums.
+        mean_sq = np.dot(self.mean, self.mean)
+        fourth = self.norm_sq_sum + 2 * mean_sq * self.norm_sum + count * mean_sq * mean_sq - 4 * np.dot(self.mean, self.norm_row_sum) + 4 * np.dot(self.mean, np.dot(self.m2, self.mean))
+        estimation = (fourth - count * np.sum(sample * sample)) / (count * count)
+        
+        return float(min(max(estimation, 0.), dispersion) / dispersion)
+    
+    # Annualized moments.
+    def Annual(self):
+        return self.Mean() * 252, self.Covariance() * 252
+    
+    def Optimizer(self, risk_free_rate, method = 'max_sharpe', target_vol = 0.05):
+        annual_mean, annual_cov = self.Annual()
+        return PortfolioOptimization.from_moments(annual_mean, annual_cov, risk_free_rate, method, target_vol)
+
 import k_data
-from collections import deque
+import esg_store
+import numpy as np
 
 class ESGFactorInvestingStrategy(QCAlgorithm):
 
@@ -175,32 +964,48 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         # Decile weighting.
         # True - Value weighted
         # False - Equally weighted
-        self.value_weighting = True
+        self.value_weighting = k_data.Parameter(self, 'value_weighting', True)
         
 
         self.symbol = 'SPY'
         self.AddEquity(self.symbol, Resolution.Daily)
         
+        # Columnar ESG cache is used when local copy of the decile file exists.
+        ESGData.store = esg_store.ESGStore.TryLoad()
+        # ESG rows are consumed only at month start selection. None - emit every row.
+        ESGData.calendar = esg_store.SamplingCalendar(esg_store.MonthStarts(self.StartDate, self.EndDate, self.Securities[self.symbol].Exchange.Hours.IsDateOpen))
         self.esg_data = self.AddData(ESGData, 'ESG', Resolution.Daily)
+        # Signals precomputed over whole store. Looked up by position of current row, None - computed from history.
+        self.signals = esg_store.ESGSignals(ESGData.store, ESGData.calendar) if ESGData.store is not None else None
+        self.signal_position = None
         
         # All tickers from ESG database.
-        self.tickers = []
+        self.universe = None
+        
+        self.ticker_deciles = None
         
-        self.ticker_deciles = {}
+        # ESG decile thresholds of long and short leg.
+        self.long_threshold = k_data.Parameter(self, 'long_threshold', 0.8)
+        self.short_threshold = k_data.Parameter(self, 'short_threshold', 0.2)
         
-        self.holding_period = 12
-        self.managed_queue = deque(maxlen = self.holding_period + 1)
+        self.holding_period = k_data.Parameter(self, 'holding_period', 12)
+        self.tranche_book = k_data.TrancheBook(self.holding_period + 1)
+        self.rebalancer = k_data.TargetRebalancer(self)
         
         self.selection_flag = False
         self.rebalance_flag = False
+        # Previous selection. Fee model is shared by all securities.
+        self.universe_tracker = k_data.UniverseTracker()
+        self.fee_model = k_data.CustomFeeModel(self)
         self.UniverseSettings.Resolution = Resolution.Daily
         self.AddUniverse(self.CoarseSelectionFunction, self.FineSelectionFunction)
         
         self.Schedule.On(self.DateRules.MonthStart(self.symbol), self.TimeRules.AfterMarketOpen(self.symbol), self.Selection)
     
     def OnSecuritiesChanged(self, changes):
+        # AddedSecurities is already the delta against previous selection. Fee model instance is shared.
         for security in changes.AddedSecurities:
-            security.SetFeeModel(k_data.CustomFeeModel(self))
+            security.SetFeeModel(self.fee_model)
     
     def CoarseSelectionFunction(self, coarse):
         if not self.selection_flag:
@@ -208,7 +1013,7 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         
         self.selection_flag = False
         
-        selected = [x.Symbol for x in coarse if (x.Symbol.Value).lower() in self.tickers]
+        selected = [x.Symbol for x in coarse if x.Symbol.Value in self.universe]
 
         return selected
     
@@ -217,29 +1022,25 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
 
         self.rebalance_flag = True
         
-        # Store symbol/market cap pair.
-        long = [[x.Symbol, (x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio))]
-                            for x in fine if (x.Symbol.Value in self.ticker_deciles) and                                                       \
-                                                (len(self.ticker_deciles[x.Symbol.Value]) == self.ticker_deciles[x.Symbol.Value].maxlen) and    \
-                                                (self.ticker_deciles[x.Symbol.Value][0] != 0) and                                               \
-                                                (self.ticker_deciles[x.Symbol.Value][0] >= 0.8) and                                             \
-                                                not self.IsInvested(x.Symbol)]
+        tickers = [x.Symbol.Value for x in fine]
+        invested = np.array([self.IsInvested(x.Symbol) for x in fine], dtype = bool)
+        market_caps = np.array([x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio) for x in fine], dtype = np.float64)
         
-        short = [[x.Symbol, (x.EarningReports.BasicAverageShares.ThreeMonths * (x.EarningReports.BasicEPS.TwelveMonths * x.ValuationRatios.PERatio))]
-                            for x in fine if (x.Symbol.Value in self.ticker_deciles) and                                                      \
-                                                (len(self.ticker_deciles[x.Symbol.Value]) == self.ticker_deciles[x.Symbol.Value].maxlen) and    \
-                                                (self.ticker_deciles[x.Symbol.Value][0] != 0) and                                               \
-                                                (self.ticker_deciles[x.Symbol.Value][0] <= 0.2) and                                             \
-                                                not self.IsInvested(x.Symbol)]
-
-        if len(long + short) == 0: 
-            # Store empty item.
-            self.managed_queue.append(RebalanceQueueItem([], []))
-            return []
+        # ESG deciles of last two months. Oldest one is used for selection.
+        if self.signal_position is not None:
+            flags = self.signals.Gather(self.signals.Flags(self.ticker_deciles.period - 1, self.long_threshold, self.short_threshold), self.signal_position, tickers)
+            long_index, short_index = k_data.FlagLegs(flags, self.ticker_deciles.IsReady(), invested)
+        else:
+            deciles, ready = self.ticker_deciles.Gather(tickers, self.ticker_deciles.period - 1)
+            long_index, short_index = k_data.ScreenLegs(deciles, ready, invested, self.long_threshold, self.short_threshold)
         
-        self.managed_queue.append(RebalanceQueueItem(long, short))
+        # New tranche. Empty one is stored too.
+        long_symbols = [fine[i].Symbol for i in long_index]
+        short_symbols = [fine[i].Symbol for i in short_index]
+        long_weights, short_weights = k_data.TrancheWeights(market_caps[long_index], market_caps[short_index], self.holding_period, self.value_weighting)
+        self.tranche_book.Append(long_symbols, long_weights, short_symbols, short_weights)
 
-        return [x[0] for x in long + short]
+        return self.universe_tracker.Select(long_symbols + short_symbols)
 
     def OnData(self, data):
         if not self.rebalance_flag:
@@ -247,68 +1048,59 @@ class ESGFactorInvestingStrategy(QCAlgorithm):
         self.rebalance_flag = False
 
         # Trade execution.
-        if len(self.managed_queue) == 0: return
+        if len(self.tranche_book) == 0: return
 
-        # Liquidate first items if queue is full.
-        if len(self.managed_queue) == self.managed_queue.maxlen:
-            item_to_liquidate = self.managed_queue.popleft()
-            for symbol, market_cap in item_to_liquidate.long_symbols + item_to_liquidate.short_symbols:
-                self.Liquidate(symbol)
+        # Roll off oldest tranche if book is full.
+        expired = self.tranche_book.PopOldest() if self.tranche_book.IsFull() else None
         
-        curr_stock_set = self.managed_queue[-1]
-        if curr_stock_set.count == 0: return
+        newest = self.tranche_book.Newest()
+        if newest.count == 0 and (expired is None or expired.count == 0): return
         
-        # Open new trades.
-        if self.value_weighting:
-            weight = 1 / (self.holding_period * 2)
-            
-            total_market_cap_long = sum([x[1] for x in curr_stock_set.long_symbols])
-            for symbol, market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight * (market_cap / total_market_cap_long))
-                
-            total_market_cap_short = sum([x[1] for x in curr_stock_set.short_symbols])
-            for symbol, market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight * (market_cap / total_market_cap_short))
-        else:
-            weight = 1 / (self.holding_period * curr_stock_set.count)
-            
-            # Equally weighted.
-            for symbol, market_cap in curr_stock_set.long_symbols:
-                self.SetHoldings(symbol, weight)
-            for symbol, market_cap in curr_stock_set.short_symbols:
-                self.SetHoldings(symbol, -weight)
+        # Trade to netted weights of all live tranches. Symbols held in several tranches are not liquidated and bought back.
+        self.rebalancer.Rebalance(self.tranche_book.NetExposure())
 
     def Selection(self):
         # Store universe tickers.
-        if len(self.tickers) == 0:
-            self.tickers = [x.Key for x in self.esg_data.GetLastData().GetStorageDictionary()]
+        data = self.esg_data.GetLastData()
+        row = data.Row
+        if self.universe is None:
+            self.universe = k_data.TickerIndex(row.schema.tickers)
+        
+        # Position of current row in precomputed signals.
+        self.signal_position = self.signals.Track(data.Index, 2) if self.signals is not None else None
 
         self.selection_flag = True
         
         # Store history for every ticker.
-        for ticker in self.tickers:
-            ticker_u = ticker.upper()
-            if ticker_u not in self.ticker_deciles:
-                self.ticker_deciles[ticker_u] = deque(maxlen = 2)
-                
-            decile = self.esg_data.GetLastData()[ticker]
-            self.ticker_deciles[ticker_u].append(decile)
+        if self.ticker_deciles is None:
+            self.ticker_deciles = k_data.CrossSectionHistory(self.universe, 2)
+        self.ticker_deciles.Append(row.values)
             
     def IsInvested(self, symbol):
         return self.Securities.ContainsKey(symbol) and self.Portfolio[symbol].Invested
 
-class RebalanceQueueItem():
-    def __init__(self, long_symbols, short_symbols):
-        self.long_symbols = long_symbols
-        self.short_symbols = short_symbols
-        self.count = len(long_symbols + short_symbols)
-        
+    # Signal panels used by FineSelectionFunction. Called by parameter sweep before runs are fanned out.
+    def PrecomputeSignals(self):
+        if self.signals is not None:
+            # Older of two stored months.
+            self.signals.Precompute(flags = [(1, self.long_threshold, self.short_threshold)])
+
 # ESG data.
 class ESGData(PythonData):
+    # Optional esg_store.ESGStore. Rows are served as views into it instead of parsing text.
+    store = None
+    # Ticker schema shared by all rows.
+    schema = None
+    # Optional esg_store.SamplingCalendar. Rows off the calendar are skipped unparsed.
+    calendar = None
+    
     def __init__(self):
-        self.tickers = []
+        self.Row = None
+        self.Index = None   # store row, None if parsed from text
     
     def GetSource(self, config, date, isLiveMode):
+        if ESGData.store is not None:
+            return SubscriptionDataSource(ESGData.store.source_path, SubscriptionTransportMedium.LocalFile, FileFormat.Csv)
         return SubscriptionDataSource("data.quantpedia.com/backtesting_data/economic/esg_deciles_data.csv", SubscriptionTransportMedium.RemoteFile, FileFormat.Csv)
     
     def Reader(self, config, line, date, isLiveMode):
@@ -316,19 +1108,30 @@ class ESGData(PythonData):
         data.Symbol = config.Symbol
         
         if not line[0].isdigit():
-            self.tickers = [x for x in line.split(';')][1:]
+            ESGData.schema = esg_store.Schema(line.split(';')[1:])
+            if ESGData.calendar is not None:
+                ESGData.calendar.Reset()
             return None
+        
+        if ESGData.calendar is not None:
+            line = ESGData.calendar.Sample(line)
+            if line is None:
+                return None
+        
+        if ESGData.store is not None:
+            index = ESGData.store.RowIndex(line)
+            if index is not None:
+                data.Time = ESGData.store.times[index]
+                data.Row = ESGData.store.Row(index)
+                data.Index = index
+                data.Value = float(data.Row.values[0])
+                return data
             
         split = line.split(';')
         
         data.Time = datetime.strptime(split[0], "%Y-%m-%d") + timedelta(days=1)
-        
-        index = 1
-        for ticker in self.tickers:
-            data[ticker] = float(split[index])
-            index += 1
-            
-        data.Value = float(split[1])
+        data.Row = esg_store.ParseRow(ESGData.schema, split)
+        data.Value = float(data.Row.values[0])
         return data
 
 
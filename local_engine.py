@@ -0,0 +1,948 @@
+# Local stand-in for the subset of the hosted engine API used by the strategies in this repo. Strategies run unchanged:
+# Install() puts engine classes into builtins where the hosted engine provides them implicitly.
+#
+# Supported: SetStartDate/SetEndDate/SetCash, AddEquity, AddData with PythonData readers over local files,
+# AddUniverse with coarse/fine callbacks, Schedule.On with MonthStart/EveryDay rules, SetHoldings/Liquidate,
+# Securities with exchange hours, Portfolio, History by count or span, GetParameter and Consolidate of daily bars
+# into periods of whole days.
+#
+# Replay is daily and deterministic. Step of trading day D happens at D 00:00:
+#   1. custom data with Time <= D becomes visible,
+#   2. coarse/fine universe selection and OnSecuritiesChanged,
+#   3. bars of previous trading day are delivered to OnData, orders fill at their close,
+#   4. scheduled events of day D, orders fill at previous close.
+# Default fee is zero, SetFeeModel overrides it per security.
+
+import os
+import sys
+import builtins
+import importlib
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+class Resolution():
+    Tick = 'Tick'
+    Second = 'Second'
+    Minute = 'Minute'
+    Hour = 'Hour'
+    Daily = 'Daily'
+
+class SubscriptionTransportMedium():
+    LocalFile = 'LocalFile'
+    RemoteFile = 'RemoteFile'
+    Rest = 'Rest'
+
+class FileFormat():
+    Csv = 'Csv'
+
+class Universe():
+    Unchanged = object()
+
+class SubscriptionDataSource():
+    def __init__(self, source, transport_medium = SubscriptionTransportMedium.LocalFile, file_format = FileFormat.Csv):
+        self.Source = source
+        self.TransportMedium = transport_medium
+        self.Format = file_format
+
+class CashAmount():
+    def __init__(self, amount, currency):
+        self.Amount = amount
+        self.Currency = currency
+
+class OrderFee():
+    def __init__(self, value):
+        self.Value = value
+
+class FeeModel():
+    def __init__(self, *args):
+        pass
+
+    def GetOrderFee(self, parameters):
+        return OrderFee(CashAmount(0, "USD"))
+
+class PythonQuandl():
+    pass
+
+# NOTE: One symbol object per ticker. Hash is engine-assigned id, so set and dict order of symbols does not depend
+# on string hash randomization and replays are repeatable across processes.
+class Symbol():
+    __slots__ = ('Value', 'id')
+
+    def __init__(self, value, id):
+        self.Value = value
+        self.id = id
+
+    def __hash__(self):
+        return self.id
+
+    def __eq__(self, other):
+        return self is other
+
+    def __str__(self):
+        return self.Value
+
+    def __repr__(self):
+        return self.Value
+
+class PythonData():
+    Symbol = None
+    Time = None
+    Value = 0.
+
+    @property
+    def EndTime(self):
+        return self.Time
+
+    @property
+    def Price(self):
+        return self.Value
+
+    def __setitem__(self, key, value):
+        if '_properties' not in self.__dict__:
+            self._properties = {}
+        self._properties[key] = value
+
+    def __getitem__(self, key):
+        return self.__dict__.get('_properties', {})[key]
+
+class TradeBar():
+    __slots__ = ('Symbol', 'Time', 'EndTime', 'Open', 'High', 'Low', 'Close', 'Volume')
+
+    def __init__(self, symbol, time, close, volume):
+        self.Symbol = symbol
+        self.Time = time
+        self.EndTime = time + timedelta(days=1)
+        self.Open = self.High = self.Low = self.Close = close
+        self.Volume = volume
+
+    @property
+    def Price(self):
+        return self.Close
+
+# NOTE: Consolidator of daily bars into periods of whole days. Periods are aligned as by the hosted engine, bar date
+# is rounded down to multiple of period counted from 0001-01-01. Bar of period is emitted at first step past its end
+# or when first bar of next period arrives.
+class DailyConsolidator():
+    def __init__(self, engine, security, period, handler):
+        days = period / timedelta(days=1)
+        if days < 1 or days != int(days):
+            raise ValueError('Local engine consolidates daily bars into whole days only, got %s.' % period)
+
+        self.engine = engine
+        self.security = security
+        self.days = int(days)
+        self.handler = handler
+        self.bar = None     # working bar
+
+    # Adds daily bar of price row.
+    def Update(self, row):
+        prices = self.engine.prices
+        close = prices.close[row, self.security.column]
+        if np.isnan(close): return
+        close = float(close)
+        volume = float(prices.volume[row, self.security.column]) if prices.volume is not None else 0.
+
+        date = Datetime(prices.dates[row])
+        start = date - timedelta(days = (date.toordinal() - 1) % self.days)
+        if self.bar is not None and self.bar.Time != start:
+            self.Emit()
+
+        bar = self.bar
+        if bar is None:
+            bar = self.bar = TradeBar(self.security.Symbol, start, close, volume)
+            bar.EndTime = start + timedelta(days = self.days)
+        else:
+            bar.High = max(bar.High, close)
+            bar.Low = min(bar.Low, close)
+            bar.Close = close
+            bar.Volume += volume
+
+    def Scan(self, time):
+        if self.bar is not None and self.bar.EndTime <= time:
+            self.Emit()
+
+    def Emit(self):
+        bar = self.bar
+        self.bar = None
+        self.handler(bar)
+
+# NOTE: Daily close panel. Rows are trading days, columns are tickers, NaN where ticker has no bar.
+class PricePanel():
+    def __init__(self, dates, tickers, close, volume = None, filled = None):
+        self.dates = np.asarray(dates, dtype = 'datetime64[D]')
+        self.tickers = list(tickers)
+        self.column = { ticker : index for index, ticker in enumerate(self.tickers) }
+        self.close = close
+        self.volume = volume
+        self.filled = filled
+
+    # Forward-filled closes for valuation and fills. Computed once per panel.
+    def Filled(self):
+        if self.filled is None:
+            self.filled = pd.DataFrame(self.close).ffill().to_numpy()
+        return self.filled
+
+    # Directory of <ticker>.csv files with date and close columns, volume is optional.
+    @staticmethod
+    def Load(directory):
+        frames = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.csv'): continue
+            frame = pd.read_csv(os.path.join(directory, name))
+            frame.columns = [x.lower() for x in frame.columns]
+            frames[name[:-4]] = frame.set_index(pd.to_datetime(frame['date']))
+
+        close = pd.DataFrame({ ticker : frame['close'] for ticker, frame in frames.items() }).sort_index()
+        volume = None
+        if all('volume' in frame for frame in frames.values()):
+            volume = pd.DataFrame({ ticker : frame['volume'] for ticker, frame in frames.items() }).reindex(close.index).to_numpy(np.float64)
+
+        return PricePanel(close.index.values.astype('datetime64[D]'), close.columns, close.to_numpy(np.float64), volume)
+
+# NOTE: Fundamental snapshots. Selection at date D sees the last snapshot dated on or before D.
+class FundamentalPanel():
+    def __init__(self, dates, tickers, shares, eps, pe):
+        self.dates = np.asarray(dates, dtype = 'datetime64[D]')
+        self.tickers = list(tickers)
+        self.column = { ticker : index for index, ticker in enumerate(self.tickers) }
+        self.shares = shares    # basic average shares, three months
+        self.eps = eps          # basic EPS, twelve months
+        self.pe = pe            # PE ratio
+
+    # Long csv with date, ticker, shares, eps, pe columns.
+    @staticmethod
+    def Load(path):
+        frame = pd.read_csv(path)
+        frame.columns = [x.lower() for x in frame.columns]
+        frame['date'] = pd.to_datetime(frame['date'])
+
+        pivots = [frame.pivot_table(index = 'date', columns = 'ticker', values = x, aggfunc = 'last') for x in ['shares', 'eps', 'pe']]
+        index = pivots[0].index
+        tickers = pivots[0].columns
+        shares, eps, pe = [x.reindex(index = index, columns = tickers).to_numpy(np.float64) for x in pivots]
+        return FundamentalPanel(index.values.astype('datetime64[D]'), tickers, shares, eps, pe)
+
+    def Snapshot(self, date):
+        return np.searchsorted(self.dates, np.datetime64(date, 'D'), 'right') - 1
+
+# Trading days of security are price panel rows with close.
+class SecurityExchangeHours():
+    def __init__(self, engine, column):
+        self.engine = engine
+        self.column = column
+
+    def IsDateOpen(self, date):
+        dates = self.engine.prices.dates
+        row = int(np.searchsorted(dates, np.datetime64(date, 'D'), 'left'))
+        return row < len(dates) and dates[row] == np.datetime64(date, 'D') and not np.isnan(self.engine.prices.close[row, self.column])
+
+class SecurityExchange():
+    def __init__(self, hours):
+        self.Hours = hours
+
+class Security():
+    def __init__(self, engine, symbol, column):
+        self.engine = engine
+        self.Symbol = symbol
+        self.column = column    # price panel column
+        self.FeeModel = None
+        self.Exchange = SecurityExchange(SecurityExchangeHours(engine, column))
+
+    def SetFeeModel(self, fee_model):
+        self.FeeModel = fee_model
+
+    @property
+    def Price(self):
+        return self.engine.Price(self.column)
+
+    @property
+    def Invested(self):
+        return self.engine.quantity[self.column] != 0
+
+    @property
+    def Holdings(self):
+        return SecurityHolding(self.engine, self)
+
+# Custom data subscription. Points are read from local file before replay.
+class CustomSecurity():
+    def __init__(self, symbol, data_type):
+        self.Symbol = symbol
+        self.data_type = data_type
+        self.points = []
+        self.position = 0   # number of visible points
+
+    def Advance(self, time):
+        while self.position < len(self.points) and self.points[self.position].Time <= time:
+            self.position += 1
+
+    def GetLastData(self):
+        return self.points[self.position - 1] if self.position > 0 else None
+
+    @property
+    def Price(self):
+        last = self.GetLastData()
+        return last.Value if last is not None else 0
+
+    @property
+    def Invested(self):
+        return False
+
+class SecurityHolding():
+    def __init__(self, engine, security):
+        self.engine = engine
+        self.security = security
+
+    @property
+    def Symbol(self):
+        return self.security.Symbol
+
+    @property
+    def Quantity(self):
+        return int(self.engine.quantity[self.security.column])
+
+    @property
+    def AbsoluteQuantity(self):
+        return abs(self.Quantity)
+
+    @property
+    def Price(self):
+        return self.security.Price
+
+    @property
+    def HoldingsValue(self):
+        return self.Quantity * self.Price
+
+    @property
+    def Invested(self):
+        return self.Quantity != 0
+
+class SecurityManager(dict):
+    def ContainsKey(self, symbol):
+        return symbol in self
+
+    # Ticker accepted in place of symbol.
+    def __missing__(self, key):
+        if isinstance(key, str):
+            for symbol, security in self.items():
+                if symbol.Value == key:
+                    return security
+        raise KeyError(key)
+
+class Portfolio():
+    def __init__(self, engine):
+        self.engine = engine
+
+    def ContainsKey(self, symbol):
+        return symbol in self.engine.securities and isinstance(self.engine.securities[symbol], Security)
+
+    def __getitem__(self, symbol):
+        return SecurityHolding(self.engine, self.engine.securities[symbol])
+
+    @property
+    def Cash(self):
+        return self.engine.cash
+
+    @property
+    def TotalPortfolioValue(self):
+        return self.engine.TotalValue()
+
+    @property
+    def Invested(self):
+        return bool(np.any(self.engine.quantity != 0))
+
+class Order():
+    def __init__(self, symbol, quantity):
+        self.Symbol = symbol
+        self.Quantity = quantity
+        self.AbsoluteQuantity = abs(quantity)
+
+class OrderFeeParameters():
+    def __init__(self, security, order):
+        self.Security = security
+        self.Order = order
+
+class SecurityChanges():
+    def __init__(self, added, removed):
+        self.AddedSecurities = added
+        self.RemovedSecurities = removed
+
+# Bars of one trading day. TradeBar objects are built on access only.
+class Bars():
+    def __init__(self, engine, row):
+        self.engine = engine
+        self.row = row
+
+    def ContainsKey(self, symbol):
+        security = self.engine.securities.get(symbol)
+        return isinstance(security, Security) and symbol in self.engine.subscribed and not np.isnan(self.engine.prices.close[self.row, security.column])
+
+    def __contains__(self, symbol):
+        return self.ContainsKey(symbol)
+
+    def __getitem__(self, symbol):
+        if not self.ContainsKey(symbol):
+            raise KeyError(symbol)
+        return self.engine.Bar(self.row, self.engine.securities[symbol])
+
+    def Keys(self):
+        return [x for x in self.engine.subscribed if self.ContainsKey(x)]
+
+class Slice():
+    def __init__(self, engine, row):
+        self.Time = engine.time
+        self.Bars = Bars(engine, row)
+
+    def ContainsKey(self, symbol):
+        return self.Bars.ContainsKey(symbol)
+
+    def __getitem__(self, symbol):
+        return self.Bars[symbol]
+
+# Coarse universe of one day. Objects are built only if callback iterates it.
+class CoarseFundamental():
+    __slots__ = ('Symbol', 'Price', 'Volume', 'DollarVolume', 'HasFundamentalData')
+
+    def __init__(self, symbol, price, volume, has_fundamental_data):
+        self.Symbol = symbol
+        self.Price = price
+        self.Volume = volume
+        self.DollarVolume = price * volume
+        self.HasFundamentalData = has_fundamental_data
+
+class CoarseUniverse():
+    def __init__(self, engine, row):
+        self.engine = engine
+        self.row = row
+
+    def __iter__(self):
+        engine = self.engine
+        close = engine.prices.close[self.row]
+        volume = engine.prices.volume[self.row] if engine.prices.volume is not None else np.zeros(len(close))
+        for column in np.flatnonzero(~np.isnan(close)).tolist():
+            yield CoarseFundamental(engine.symbols[column], float(close[column]), float(volume[column]), engine.fundamental_column[column] != -1)
+
+class Value():
+    __slots__ = ('ThreeMonths', 'TwelveMonths')
+
+    def __init__(self, three_months = 0., twelve_months = 0.):
+        self.ThreeMonths = three_months
+        self.TwelveMonths = twelve_months
+
+class EarningReports():
+    __slots__ = ('BasicAverageShares', 'BasicEPS')
+
+    def __init__(self, shares, eps):
+        self.BasicAverageShares = Value(three_months = shares)
+        self.BasicEPS = Value(twelve_months = eps)
+
+class ValuationRatios():
+    __slots__ = ('PERatio',)
+
+    def __init__(self, pe):
+        self.PERatio = pe
+
+class FineFundamental():
+    __slots__ = ('Symbol', 'EarningReports', 'ValuationRatios', 'MarketCap')
+
+    def __init__(self, symbol, shares, eps, pe):
+        self.Symbol = symbol
+        self.EarningReports = EarningReports(shares, eps)
+        self.ValuationRatios = ValuationRatios(pe)
+        self.MarketCap = shares * eps * pe
+
+class MonthStartRule():
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+class EveryDayRule():
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+class DateRules():
+    def MonthStart(self, symbol):
+        return MonthStartRule(symbol.Value if isinstance(symbol, Symbol) else symbol)
+
+    def EveryDay(self, symbol):
+        return EveryDayRule(symbol.Value if isinstance(symbol, Symbol) else symbol)
+
+class TimeRules():
+    # Replay is daily, time of day only orders events after OnData.
+    def AfterMarketOpen(self, symbol, minutes = 0):
+        return minutes
+
+    def BeforeMarketClose(self, symbol, minutes = 0):
+        return minutes
+
+class ScheduleManager():
+    def __init__(self):
+        self.events = []    # (date rule, callback)
+
+    def On(self, date_rule, time_rule, callback):
+        self.events.append((date_rule, callback))
+
+class UniverseSettings():
+    def __init__(self):
+        self.Resolution = Resolution.Minute
+
+# NOTE: Base algorithm. Engine state lives in LocalEngine, algorithm methods only forward to it.
+class QCAlgorithm():
+    def __init__(self):
+        self.engine = None
+
+    def Initialize(self):
+        pass
+
+    def OnData(self, data):
+        pass
+
+    def OnSecuritiesChanged(self, changes):
+        pass
+
+    @property
+    def Time(self):
+        return self.engine.time
+
+    @property
+    def StartDate(self):
+        return self.engine.start
+
+    @property
+    def EndDate(self):
+        return self.engine.end
+
+    @property
+    def Securities(self):
+        return self.engine.securities
+
+    @property
+    def Portfolio(self):
+        return self.engine.portfolio
+
+    @property
+    def Schedule(self):
+        return self.engine.schedule
+
+    @property
+    def UniverseSettings(self):
+        return self.engine.universe_settings
+
+    @property
+    def DateRules(self):
+        return self.engine.date_rules
+
+    @property
+    def TimeRules(self):
+        return self.engine.time_rules
+
+    @property
+    def IsWarmingUp(self):
+        return False
+
+    def SetStartDate(self, year, month, day):
+        self.engine.SetStart(datetime(year, month, day))
+
+    def SetEndDate(self, year, month, day):
+        self.engine.SetEnd(datetime(year, month, day))
+
+    def SetCash(self, cash):
+        self.engine.cash = float(cash)
+
+    def AddEquity(self, ticker, resolution = Resolution.Daily):
+        return self.engine.AddEquity(ticker)
+
+    def AddData(self, data_type, ticker, resolution = Resolution.Daily):
+        return self.engine.AddData(data_type, ticker)
+
+    def AddUniverse(self, coarse, fine = None):
+        self.engine.coarse = coarse
+        self.engine.fine = fine
+
+    # Period is timedelta of whole days or Resolution.Daily.
+    def Consolidate(self, symbol, period, handler):
+        self.engine.Consolidate(symbol, timedelta(days=1) if period == Resolution.Daily else period, handler)
+
+    # Periods is bar count or timedelta span ending at current time.
+    def History(self, symbols, periods, resolution = Resolution.Daily):
+        return self.engine.History(symbols, periods)
+
+    def SetHoldings(self, symbol, percentage):
+        self.engine.SetHoldings(symbol, percentage)
+
+    def Liquidate(self, symbol = None):
+        self.engine.Liquidate(symbol)
+
+    # Parameter as string or None if it's not set.
+    def GetParameter(self, name):
+        value = self.engine.parameters.get(name)
+        return None if value is None else str(value)
+
+    def Debug(self, message):
+        self.engine.logs.append((self.engine.time, str(message)))
+
+    def Log(self, message):
+        self.Debug(message)
+
+class BacktestResult():
+    def __init__(self, dates, equity, orders, fees, logs):
+        self.dates = dates      # datetime64[D] of recorded days
+        self.equity = equity    # total portfolio value at end of every day
+        self.orders = orders
+        self.fees = fees
+        self.logs = logs
+
+    def Statistics(self):
+        returns = self.equity[1:] / self.equity[:-1] - 1 if len(self.equity) > 1 else np.zeros(1)
+        years = max(len(returns), 1) / 252
+        volatility = float(returns.std() * np.sqrt(252))
+        peak = np.maximum.accumulate(self.equity) if len(self.equity) != 0 else np.ones(1)
+
+        return {
+            'total_return' : float(self.equity[-1] / self.equity[0] - 1) if len(self.equity) != 0 else 0.,
+            'annual_return' : float((self.equity[-1] / self.equity[0]) ** (1 / years) - 1) if len(self.equity) != 0 else 0.,
+            'volatility' : volatility,
+            'sharpe' : float(returns.mean() * 252 / volatility) if volatility > 0 else 0.,
+            'max_drawdown' : float((self.equity / peak - 1).min()) if len(self.equity) != 0 else 0.,
+            'orders' : self.orders,
+            'fees' : self.fees
+        }
+
+# NOTE: Daily replay engine. Holdings are one quantity vector over price panel columns and portfolio value is one
+# dot product with forward-filled close row, so per-day cost does not depend on number of Python objects held.
+class LocalEngine():
+    # parameters - values returned by GetParameter, e.g. from parameter sweep
+    def __init__(self, prices, fundamentals = None, data_dir = '.', start = None, end = None, parameters = None):
+        self.prices = prices
+        self.fundamentals = fundamentals
+        self.data_dir = data_dir
+        self.start_override = start
+        self.end_override = end
+        self.parameters = parameters if parameters is not None else {}
+
+        self.filled = prices.Filled()
+
+        self.symbols = [Symbol(ticker, index) for index, ticker in enumerate(prices.tickers)]
+        if fundamentals is not None:
+            self.fundamental_column = np.array([fundamentals.column.get(x, -1) for x in prices.tickers], dtype = np.int64)
+        else:
+            self.fundamental_column = np.full(len(prices.tickers), -1, dtype = np.int64)
+
+    def Reset(self):
+        self.start = self.start_override
+        self.end = self.end_override
+        self.time = self.start
+        self.row = -1   # price row of current prices
+        self.cash = 100000.
+        self.quantity = np.zeros(len(self.prices.tickers), dtype = np.int64)
+        self.securities = SecurityManager()
+        self.custom = []
+        self.custom_symbols = {}
+        self.portfolio = Portfolio(self)
+        self.schedule = ScheduleManager()
+        self.universe_settings = UniverseSettings()
+        self.date_rules = DateRules()
+        self.time_rules = TimeRules()
+        self.coarse = None
+        self.fine = None
+        self.subscribed = set()     # manually added and universe symbols
+        self.manual = set()
+        self.selected = []
+        self.consolidators = []
+        self.orders = 0
+        self.fees = 0.
+        self.logs = []
+
+    def SetStart(self, date):
+        if self.start_override is None:
+            self.start = self.time = date
+
+    def SetEnd(self, date):
+        if self.end_override is None:
+            self.end = date
+
+    # New algorithm instance after Initialize, without replay.
+    def Initialize(self, algorithm_type):
+        self.Reset()
+        algorithm = algorithm_type()
+        algorithm.engine = self
+        self.algorithm = algorithm
+
+        if self.start is not None:
+            self.time = self.start
+        algorithm.Initialize()
+        return algorithm
+
+    def Run(self, algorithm_type):
+        algorithm = self.Initialize(algorithm_type)
+
+        dates = self.prices.dates
+        first = int(np.searchsorted(dates, np.datetime64(self.start, 'D'), 'left'))
+        last = int(np.searchsorted(dates, np.datetime64(self.end, 'D'), 'right')) - 1
+
+        for security in self.custom:
+            self.ReadCustom(security)
+        events = [(self.EventMask(rule), callback) for rule, callback in self.schedule.events]
+
+        recorded = []
+        equity = []
+        for t in range(first, last + 2):
+            trading = t <= last
+            self.time = Datetime(dates[t]) if trading else Datetime(dates[last]) + timedelta(days=1)
+
+            for security in self.custom:
+                security.Advance(self.time)
+
+            if trading and self.coarse is not None:
+                self.SelectUniverse(t)
+
+            # Bar of previous trading day. Consolidated bars are handled before OnData.
+            if t - 1 >= first:
+                self.row = t - 1
+                for consolidator in self.consolidators:
+                    consolidator.Update(t - 1)
+                    consolidator.Scan(self.time)
+                algorithm.OnData(Slice(self, t - 1))
+            elif t > 0:
+                self.row = t - 1
+
+            if trading:
+                for mask, callback in events:
+                    if mask[t]: callback()
+
+            if t - 1 >= first:
+                recorded.append(dates[t - 1])
+                equity.append(self.TotalValue())
+
+        return BacktestResult(np.array(recorded, dtype = 'datetime64[D]'), np.array(equity), self.orders, self.fees, self.logs)
+
+    # Boolean mask of trading rows on which rule fires.
+    def EventMask(self, rule):
+        column = self.prices.column[rule.ticker]
+        valid = ~np.isnan(self.prices.close[:, column])
+        if isinstance(rule, EveryDayRule):
+            return valid
+
+        rows = np.flatnonzero(valid)
+        months = self.prices.dates[rows].astype('datetime64[M]')
+        first = np.ones(len(rows), dtype = bool)
+        first[1:] = months[1:] != months[:-1]
+        # Panel starting mid-month has no month start in its first month.
+        if len(rows) != 0:
+            first[0] = self.prices.dates[rows[0]] == np.busday_offset(months[0].astype('datetime64[D]'), 0, roll = 'forward')
+
+        mask = np.zeros(len(valid), dtype = bool)
+        mask[rows[first]] = True
+        return mask
+
+    def AddEquity(self, ticker):
+        symbol = self.symbols[self.prices.column[ticker]]
+        security = self.Subscribe(symbol)
+        self.manual.add(symbol)
+        return security
+
+    def Subscribe(self, symbol):
+        if symbol not in self.securities:
+            self.securities[symbol] = Security(self, symbol, symbol.id)
+        self.subscribed.add(symbol)
+        return self.securities[symbol]
+
+    def AddData(self, data_type, ticker):
+        symbol = Symbol(ticker, len(self.symbols) + len(self.custom))
+        security = CustomSecurity(symbol, data_type)
+        self.securities[symbol] = security
+        self.custom.append(security)
+        return security
+
+    # Local path of data source. Remote sources are looked up under data directory by url path and file name.
+    def ResolveSource(self, source):
+        if source.TransportMedium == SubscriptionTransportMedium.LocalFile and os.path.exists(source.Source):
+            return source.Source
+
+        path = source.Source.split('://', 1)[-1]
+        candidates = [os.path.join(self.data_dir, path.split('/', 1)[-1]), os.path.join(self.data_dir, os.path.basename(path))]
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return candidate
+        raise FileNotFoundError('No local copy of ' + source.Source)
+
+    def ReadCustom(self, security):
+        reader = security.data_type()
+        config = SubscriptionConfig(security.Symbol)
+        path = self.ResolveSource(reader.GetSource(config, self.start, False))
+
+        points = []
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if len(line) == 0: continue
+                point = reader.Reader(config, line, self.start, False)
+                if point is not None:
+                    points.append(point)
+
+        # Points are emitted in time order.
+        points.sort(key = lambda x: x.Time)
+        security.points = points
+
+    def SelectUniverse(self, t):
+        # Selection sees prices of previous trading day.
+        selected = self.coarse(CoarseUniverse(self, t - 1 if t > 0 else t))
+        if selected is Universe.Unchanged:
+            return
+
+        selected = list(selected)
+        if self.fine is not None:
+            selected = self.fine(self.FineUniverse(selected, t))
+            if selected is Universe.Unchanged:
+                return
+            selected = list(selected)
+
+        previous = set(self.selected)
+        current = set(selected)
+        added = [self.Subscribe(x) for x in selected if x not in previous]
+        removed = [self.securities[x] for x in self.selected if x not in current]
+        for security in removed:
+            if security.Symbol not in self.manual:
+                self.subscribed.discard(security.Symbol)
+        self.selected = selected
+
+        if len(added) != 0 or len(removed) != 0:
+            self.algorithm.OnSecuritiesChanged(SecurityChanges(added, removed))
+
+    def FineUniverse(self, symbols, t):
+        fundamentals = self.fundamentals
+        if fundamentals is None:
+            return []
+
+        snapshot = fundamentals.Snapshot(self.prices.dates[t])
+        if snapshot < 0:
+            return []
+
+        fine = []
+        for symbol in symbols:
+            column = self.fundamental_column[symbol.id]
+            if column == -1: continue
+            values = [fundamentals.shares[snapshot, column], fundamentals.eps[snapshot, column], fundamentals.pe[snapshot, column]]
+            values = [0. if np.isnan(x) else float(x) for x in values]
+            fine.append(FineFundamental(symbol, *values))
+        return fine
+
+    def Price(self, column):
+        if self.row < 0: return 0.
+        price = self.filled[self.row, column]
+        return 0. if np.isnan(price) else float(price)
+
+    def TotalValue(self):
+        if self.row < 0: return self.cash
+        # Orders fill at forward-filled price only, so held columns always have one.
+        held = np.flatnonzero(self.quantity)
+        return self.cash + float(np.dot(self.quantity[held], self.filled[self.row, held]))
+
+    def Bar(self, row, security):
+        volume = self.prices.volume[row, security.column] if self.prices.volume is not None else 0.
+        return TradeBar(security.Symbol, Datetime(self.prices.dates[row]), float(self.prices.close[row, security.column]), float(volume))
+
+    def Consolidate(self, symbol, period, handler):
+        self.consolidators.append(DailyConsolidator(self, self.securities[symbol], period, handler))
+
+    # Last `periods` bars or bars ended within `periods` timedelta.
+    def History(self, symbols, periods):
+        if isinstance(symbols, Symbol):
+            symbols = [symbols]
+
+        # Bars ended before current time.
+        end = int(np.searchsorted(self.prices.dates, np.datetime64(self.time, 'D'), 'left'))
+        begin = int(np.searchsorted(self.prices.dates, np.datetime64(self.time - periods, 'D'), 'left')) if isinstance(periods, timedelta) else None
+        frames = []
+        for symbol in symbols:
+            close = self.prices.close[:end, self.prices.column[symbol.Value]]
+            rows = np.flatnonzero(~np.isnan(close))
+            rows = rows[rows >= begin] if begin is not None else rows[-periods:]
+            times = pd.DatetimeIndex(self.prices.dates[rows] + np.timedelta64(1, 'D'))
+            frames.append(pd.DataFrame({ 'open' : close[rows], 'high' : close[rows], 'low' : close[rows], 'close' : close[rows] },
+                index = pd.MultiIndex.from_arrays([[symbol.Value] * len(rows), times], names = ['symbol', 'time'])))
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+        history = pd.concat(frames)
+        return history if len(history) != 0 else pd.DataFrame()
+
+    def SetHoldings(self, symbol, percentage):
+        security = self.securities[symbol]
+        price = security.Price
+        if price <= 0:
+            self.logs.append((self.time, 'No price for ' + symbol.Value))
+            return
+
+        target = int(percentage * self.TotalValue() / price)
+        self.Fill(security, target - self.quantity[security.column])
+
+    def Liquidate(self, symbol = None):
+        if symbol is None:
+            symbols = [self.symbols[x] for x in np.flatnonzero(self.quantity)]
+        else:
+            symbols = [symbol]
+
+        for symbol in symbols:
+            security = self.securities.get(symbol)
+            if not isinstance(security, Security): continue
+            self.Fill(security, - self.quantity[security.column])
+
+    def Fill(self, security, quantity):
+        quantity = int(quantity)
+        if quantity == 0: return
+
+        price = security.Price
+        fee = 0.
+        if security.FeeModel is not None:
+            fee = float(security.FeeModel.GetOrderFee(OrderFeeParameters(security, Order(security.Symbol, quantity))).Value.Amount)
+
+        self.quantity[security.column] += quantity
+        self.cash -= quantity * price + fee
+        self.orders += 1
+        self.fees += fee
+
+class SubscriptionConfig():
+    def __init__(self, symbol):
+        self.Symbol = symbol
+
+def Datetime(date):
+    return datetime.combine(date.astype(object), datetime.min.time())
+
+# Names the hosted engine provides to algorithm modules without import.
+def Install():
+    names = {
+        'QCAlgorithm' : QCAlgorithm,
+        'PythonData' : PythonData,
+        'PythonQuandl' : PythonQuandl,
+        'FeeModel' : FeeModel,
+        'OrderFee' : OrderFee,
+        'CashAmount' : CashAmount,
+        'Resolution' : Resolution,
+        'SubscriptionDataSource' : SubscriptionDataSource,
+        'SubscriptionTransportMedium' : SubscriptionTransportMedium,
+        'FileFormat' : FileFormat,
+        'Universe' : Universe,
+        'datetime' : datetime,
+        'timedelta' : timedelta
+    }
+    for name, value in names.items():
+        setattr(builtins, name, value)
+
+# Runs algorithm class of module over data directory with equity/<ticker>.csv price files,
+# optional fundamentals.csv and local copies of custom data sources.
+def Backtest(module, algorithm, data_dir = '.', prices = None, fundamentals = None, start = None, end = None):
+    Install()
+    algorithm_type = getattr(importlib.import_module(module), algorithm)
+
+    if prices is None:
+        prices = PricePanel.Load(os.path.join(data_dir, 'equity'))
+    if fundamentals is None and os.path.exists(os.path.join(data_dir, 'fundamentals.csv')):
+        fundamentals = FundamentalPanel.Load(os.path.join(data_dir, 'fundamentals.csv'))
+
+    return LocalEngine(prices, fundamentals, data_dir, start, end).Run(algorithm_type)
+
+if __name__ == '__main__':
+    # python local_engine.py <module> <algorithm class> [data directory]
+    result = Backtest(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else '.')
+    for key, value in result.Statistics().items():
+        print(key, value)
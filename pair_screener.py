@@ -0,0 +1,130 @@
+# Paired-switching screener. The rotation in Rotational_Pair.py is run on a single SPY/AGG pair that is assumed to be
+# negatively correlated. Here every pair of a candidate universe is scored by its rolling correlation with matrix
+# operations, the most negatively correlated pairs are ranked and the switching rule is backtested on the top pairs
+# in parallel.
+#
+# Prices are passed as aligned (time x assets) matrix of daily closes without missing values.
+# Screener runs offline, engine names used by k_data are provided by local_engine (also in spawned workers).
+
+import multiprocessing
+import numpy as np
+import local_engine
+
+local_engine.Install()
+
+import k_data
+
+bond_etfs = ['AGG','BND','TLT','IEF','SHY','LQD','HYG','TIP','MUB','EMB']
+sector_etfs = ['XLB','XLE','XLF','XLI','XLK','XLP','XLU','XLV','XLY','XLRE','XLC']
+
+# Default candidate universe.
+def Candidates():
+    return k_data.sp100_index.tickers + bond_etfs + sector_etfs
+
+# Mean correlation of every pair over rolling windows ending every `step` rows. Assets x assets matrix.
+def RollingCorrelation(prices, window = 252, step = 63):
+    returns = k_data.BatchReturns(prices)
+    ends = range(window, len(returns) + 1, step)
+
+    total = np.zeros((returns.shape[1], returns.shape[1]))
+    for end in ends:
+        sample = returns[end - window:end]
+        deviations = sample - sample.mean(axis = 0)
+        scale = np.sqrt(np.einsum('ij,ij->j', deviations, deviations))
+        scale[scale == 0] = np.inf
+        standardized = deviations / scale
+        total += np.dot(standardized.T, standardized)
+
+    return total / max(len(ends), 1)
+
+# Indexes of `count` most negatively correlated pairs, most negative first.
+def TopPairs(correlation, count):
+    first, second = np.triu_indices(len(correlation), k = 1)
+    scores = correlation[first, second]
+
+    count = min(count, len(scores))
+    if count == 0:
+        return first[:0], second[:0], scores[:0]
+
+    top = np.argpartition(scores, count - 1)[:count]
+    top = top[np.argsort(scores[top], kind = 'stable')]
+    return first[top], second[top], scores[top]
+
+# Switching rule of PairedSwitching for many pairs at once. Every `period` rows the asset with higher performance
+# over `lookback` rows is held until next switch. Returns daily strategy returns, (time - lookback - 1) x pairs.
+def SwitchingReturns(prices, first, second, lookback = 63, period = 63):
+    prices = np.asarray(prices, dtype = np.float64)
+    first_prices = prices[:, first]
+    second_prices = prices[:, second]
+
+    rebalance = np.arange(lookback, len(prices) - 1, period)
+    first_performance = (first_prices[rebalance] - first_prices[rebalance - lookback]) / first_prices[rebalance]
+    second_performance = (second_prices[rebalance] - second_prices[rebalance - lookback]) / second_prices[rebalance]
+    hold_first = first_performance > second_performance
+
+    # Position decided at rebalance row earns returns until next rebalance row.
+    held = np.repeat(hold_first, np.diff(np.append(rebalance, len(prices) - 1)), axis = 0)
+    first_returns = k_data.BatchReturns(first_prices[lookback:])
+    second_returns = k_data.BatchReturns(second_prices[lookback:])
+    return np.where(held, first_returns, second_returns)
+
+def Metrics(returns):
+    equity = np.cumprod(1 + returns, axis = 0)
+    years = len(returns) / 252
+    volatility = returns.std(axis = 0) * np.sqrt(252)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        sharpe = np.where(volatility > 0, returns.mean(axis = 0) * 252 / volatility, 0.)
+
+    return {
+        'total_return' : equity[-1] - 1,
+        'annual_return' : equity[-1] ** (1 / years) - 1,
+        'volatility' : volatility,
+        'sharpe' : sharpe,
+        'max_drawdown' : k_data.BatchDrawdown(equity)[1]
+    }
+
+# NOTE: Backtests run across process pool. Price matrix is handed to every worker once at start,
+# tasks only carry chunks of pair indexes.
+screener_prices = None
+
+def InitScreenerWorker(prices):
+    global screener_prices
+    screener_prices = prices
+
+def BacktestChunk(task):
+    first, second, lookback, period = task
+    return Metrics(SwitchingReturns(screener_prices, first, second, lookback, period))
+
+# Metrics of switching rule for every pair. processes = 1 runs in current process.
+def BacktestPairs(prices, first, second, lookback = 63, period = 63, processes = None):
+    prices = np.asarray(prices, dtype = np.float64)
+    if len(first) == 0:
+        return Metrics(np.zeros((2, 0)))
+
+    chunks = max(1, min(len(first), (processes or multiprocessing.cpu_count()) * 4))
+    tasks = [(x, y, lookback, period) for x, y in zip(np.array_split(first, chunks), np.array_split(second, chunks)) if len(x) != 0]
+
+    if processes == 1:
+        InitScreenerWorker(prices)
+        results = [BacktestChunk(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer = InitScreenerWorker, initargs = (prices,)) as pool:
+            results = pool.map(BacktestChunk, tasks)
+
+    return { key : np.concatenate([x[key] for x in results]) for key in results[0] }
+
+# Ranks most negatively correlated pairs of universe and backtests switching rule on top `count` of them.
+# Returns list of result rows ordered by correlation.
+def Screen(prices, tickers, count = 20, window = 252, step = 63, lookback = 63, period = 63, processes = None):
+    correlation = RollingCorrelation(prices, window, step)
+    first, second, scores = TopPairs(correlation, count)
+    metrics = BacktestPairs(prices, first, second, lookback, period, processes)
+
+    rows = []
+    for i in range(len(first)):
+        row = { 'first' : tickers[first[i]], 'second' : tickers[second[i]], 'correlation' : float(scores[i]) }
+        for key in metrics:
+            row[key] = float(metrics[key][i])
+        rows.append(row)
+    return rows
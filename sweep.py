@@ -0,0 +1,258 @@
+# Parallel parameter sweep. Every combination of a parameter grid is replayed by local_engine in a process pool,
+# parameters reach strategies through GetParameter. Price and fundamental panels are written once as .npy files and
+# memory-mapped read-only by every worker, ESG deciles and signal panels are shared the same way through ESGStore
+# caches built by the parent.
+#
+# Finished runs are appended to one csv results table as they complete. Sweep started again with the same results
+# file skips runs already finished, so interrupted sweep resumes. Runs raising exception are recorded with status
+# 'error' and retried on resume. If a worker process dies, the pool breaks and runs lost with it are resubmitted to
+# a fresh pool. Runs which were executing when a pool broke are suspects, run in broken pool isolate_after times is
+# rerun alone in single process pool. Run killing its process max_attempts times is recorded as 'crashed'.
+#
+# python sweep.py <data directory> <results.csv> [processes]
+
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import itertools
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import local_engine
+
+# module, algorithm class, parameter grid
+SWEEPS = [
+    ('esg_factors', 'ESGFactorInvestingStrategy', {
+        'holding_period' : [3, 6, 12],
+        'value_weighting' : [True, False],
+        'long_threshold' : [0.7, 0.8, 0.9],
+        'short_threshold' : [0.1, 0.2, 0.3]
+    }),
+    ('ESG_Momentum', 'ESGFactorMomentumStrategy', {
+        'holding_period' : [1, 3, 6],
+        'period' : [7, 14],
+        'value_weighting' : [True, False]
+    }),
+    ('Rotational_Pair', 'PairedSwitching', {
+        'lookback' : [21, 63, 126],
+        'rebalance_months' : [1, 3, 6]
+    })
+]
+
+METRICS = ['total_return', 'annual_return', 'volatility', 'sharpe', 'max_drawdown', 'orders', 'fees']
+
+class SweepTask():
+    __slots__ = ('id', 'module', 'algorithm', 'parameters')
+
+    def __init__(self, module, algorithm, parameters):
+        self.module = module
+        self.algorithm = algorithm
+        self.parameters = parameters
+        self.id = hashlib.sha1(json.dumps([module, algorithm, parameters], sort_keys = True).encode()).hexdigest()[:12]
+
+def Tasks(sweeps):
+    tasks = []
+    for module, algorithm, grid in sweeps:
+        names = sorted(grid)
+        for values in itertools.product(*[grid[x] for x in names]):
+            tasks.append(SweepTask(module, algorithm, dict(zip(names, values))))
+    return tasks
+
+# Panels written as .npy files for memory-mapping in workers.
+def SharePanels(prices, fundamentals, directory):
+    os.makedirs(directory, exist_ok = True)
+
+    arrays = { 'dates' : prices.dates, 'close' : prices.close, 'filled' : prices.Filled() }
+    if prices.volume is not None:
+        arrays['volume'] = prices.volume
+    if fundamentals is not None:
+        arrays.update({ 'fundamental_dates' : fundamentals.dates, 'shares' : fundamentals.shares, 'eps' : fundamentals.eps, 'pe' : fundamentals.pe })
+
+    for name, values in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(values))
+
+    meta = { 'tickers' : prices.tickers, 'fundamental_tickers' : fundamentals.tickers if fundamentals is not None else None }
+    with open(os.path.join(directory, 'panels.json'), 'w') as f:
+        json.dump(meta, f)
+
+def LoadPanels(directory):
+    def Load(name):
+        path = os.path.join(directory, name + '.npy')
+        return np.load(path, mmap_mode = 'r') if os.path.exists(path) else None
+
+    with open(os.path.join(directory, 'panels.json')) as f:
+        meta = json.load(f)
+
+    prices = local_engine.PricePanel(Load('dates'), meta['tickers'], Load('close'), Load('volume'), Load('filled'))
+    fundamentals = None
+    if meta['fundamental_tickers'] is not None:
+        fundamentals = local_engine.FundamentalPanel(Load('fundamental_dates'), meta['fundamental_tickers'], Load('shares'), Load('eps'), Load('pe'))
+    return prices, fundamentals
+
+# NOTE: Worker state. Panels are mapped once per worker process, tasks only carry parameters.
+sweep_prices = None
+sweep_fundamentals = None
+sweep_data_dir = None
+sweep_period = None
+sweep_running_dir = None
+
+def InitSweepWorker(data_dir, panel_dir, start, end):
+    global sweep_prices, sweep_fundamentals, sweep_data_dir, sweep_period, sweep_running_dir
+    local_engine.Install()
+    # ESGStore and signal caches are looked up relative to working directory.
+    os.chdir(data_dir)
+    sweep_data_dir = data_dir
+    sweep_prices, sweep_fundamentals = LoadPanels(panel_dir)
+    sweep_period = (start, end)
+    sweep_running_dir = RunningDir(panel_dir)
+
+# Marker files of runs executing in workers. Marker of run is left behind if its process dies.
+def RunningDir(panel_dir):
+    return os.path.join(panel_dir, 'running')
+
+def RunTask(task):
+    start = time.perf_counter()
+    marker = os.path.join(sweep_running_dir, task.id)
+    open(marker, 'w').close()
+    try:
+        algorithm_type = getattr(importlib.import_module(task.module), task.algorithm)
+        engine = local_engine.LocalEngine(sweep_prices, sweep_fundamentals, sweep_data_dir, sweep_period[0], sweep_period[1], task.parameters)
+        statistics = engine.Run(algorithm_type).Statistics()
+        return 'ok', statistics, time.perf_counter() - start, ''
+    except Exception as e:
+        return 'error', {}, time.perf_counter() - start, repr(e)
+    finally:
+        os.remove(marker)
+
+def Columns(tasks):
+    parameters = sorted(set(name for task in tasks for name in task.parameters))
+    return ['run_id', 'module', 'algorithm'] + parameters + METRICS + ['wall', 'status', 'error']
+
+# Last status of every run in results table.
+def ReadStatus(results_path, columns):
+    status = {}
+    if not os.path.exists(results_path) or os.path.getsize(results_path) == 0:
+        return status
+
+    with open(results_path, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header != columns:
+            raise ValueError('Results table %s has different columns, use new results file for changed grid.' % results_path)
+        for row in reader:
+            if len(row) == len(columns):
+                status[row[0]] = row[columns.index('status')]
+    return status
+
+def Sweep(data_dir, results_path, sweeps = SWEEPS, processes = None, max_attempts = 3, isolate_after = 2, start = None, end = None, prices = None, fundamentals = None):
+    data_dir = os.path.abspath(data_dir)
+    tasks = Tasks(sweeps)
+    columns = Columns(tasks)
+    status = ReadStatus(results_path, columns)
+    pending = [task for task in tasks if status.get(task.id) != 'ok']
+
+    if len(pending) != 0:
+        if prices is None:
+            prices = local_engine.PricePanel.Load(os.path.join(data_dir, 'equity'))
+        if fundamentals is None and os.path.exists(os.path.join(data_dir, 'fundamentals.csv')):
+            fundamentals = local_engine.FundamentalPanel.Load(os.path.join(data_dir, 'fundamentals.csv'))
+
+        panel_dir = os.path.abspath(results_path) + '.panels'
+        SharePanels(prices, fundamentals, panel_dir)
+        os.makedirs(RunningDir(panel_dir), exist_ok = True)
+
+        # ESG caches are built once before workers map them.
+        PrecomputeSignals(data_dir, pending, prices, fundamentals, start, end)
+
+        new_table = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+        with open(results_path, 'a', newline = '') as f:
+            writer = csv.writer(f)
+            if new_table:
+                writer.writerow(columns)
+                f.flush()
+
+            def Write(task, result):
+                writer.writerow(Row(task, result, columns))
+                f.flush()
+
+            initargs = (data_dir, panel_dir, start, end)
+            broken = {}     # run id -> broken pools the run was executing in
+            while len(pending) != 0:
+                shared = [task for task in pending if broken.get(task.id, 0) < isolate_after]
+                lost = RunPool(shared, processes, initargs, Write) if len(shared) != 0 else []
+
+                # Suspects are rerun one per pool, so crash is attributed to the run causing it.
+                for task in pending:
+                    if broken.get(task.id, 0) >= isolate_after:
+                        lost += RunPool([task], 1, initargs, Write)
+
+                # Pool broken before any run started (e.g. in worker initializer) counts against all lost runs.
+                started = any(running for task, running in lost)
+                pending = []
+                for task, running in lost:
+                    if running or not started:
+                        broken[task.id] = broken.get(task.id, 0) + 1
+                    if broken.get(task.id, 0) >= max_attempts:
+                        Write(task, ('crashed', {}, 0., 'worker process died'))
+                    else:
+                        pending.append(task)
+
+    return ReadResults(results_path)
+
+# Signal panels of ESG runs are computed by parent process for lags and thresholds of every pending run, workers
+# only map cached panels.
+def PrecomputeSignals(data_dir, tasks, prices, fundamentals, start, end):
+    local_engine.Install()
+    # ESGStore is looked up relative to working directory.
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        for task in tasks:
+            algorithm_type = getattr(importlib.import_module(task.module), task.algorithm)
+            if not hasattr(algorithm_type, 'PrecomputeSignals'): continue
+            engine = local_engine.LocalEngine(prices, fundamentals, data_dir, start, end, task.parameters)
+            engine.Initialize(algorithm_type).PrecomputeSignals()
+    finally:
+        os.chdir(cwd)
+
+# Runs tasks in process pool and writes their results. Returns (task, running) of tasks lost because a worker process
+# died, running - task was executing in a worker when the pool broke.
+def RunPool(tasks, processes, initargs, write):
+    running_dir = RunningDir(initargs[1])
+    lost = []
+    with ProcessPoolExecutor(processes, initializer = InitSweepWorker, initargs = initargs) as pool:
+        futures = { pool.submit(RunTask, task) : task for task in tasks }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                lost.append(futures[future])
+                continue
+            write(futures[future], result)
+
+    lost = [(task, os.path.exists(os.path.join(running_dir, task.id))) for task in lost]
+    for task, running in lost:
+        if running:
+            os.remove(os.path.join(running_dir, task.id))
+    return lost
+
+def Row(task, result, columns):
+    state, statistics, wall, error = result
+    values = { 'run_id' : task.id, 'module' : task.module, 'algorithm' : task.algorithm, 'wall' : wall, 'status' : state, 'error' : error }
+    values.update(task.parameters)
+    values.update(statistics)
+    return [values.get(x, '') for x in columns]
+
+# Results table with last row of every run.
+def ReadResults(results_path):
+    import pandas as pd
+    results = pd.read_csv(results_path, on_bad_lines = 'skip')
+    return results.drop_duplicates('run_id', keep = 'last').reset_index(drop = True)
+
+if __name__ == '__main__':
+    results = Sweep(sys.argv[1], sys.argv[2], processes = int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print(results.groupby(['algorithm', 'status']).size())